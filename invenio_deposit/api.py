@@ -24,8 +24,9 @@
 
 """Deposit API."""
 
+import threading
 import uuid
-from contextlib import contextmanager
+from copy import deepcopy
 from functools import partial, wraps
 
 from dictdiffer import patch
@@ -34,21 +35,29 @@ from elasticsearch.exceptions import RequestError
 from flask import current_app
 from flask_login import current_user
 from invenio_db import db
-from invenio_files_rest.models import Bucket
+from invenio_files_rest.models import Bucket, ObjectVersion
 from invenio_indexer.api import RecordIndexer
 from invenio_pidstore import current_pidstore
 from invenio_pidstore.errors import PIDInvalidAction
 from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_pidstore.resolver import Resolver
-from invenio_records.signals import after_record_update, before_record_update
+from invenio_records.errors import MissingModelError
+from invenio_records.models import RecordMetadata
+from invenio_records.signals import after_record_insert, \
+    after_record_update, before_record_insert, before_record_update
 from invenio_records_files.api import Record
 from invenio_records_files.models import RecordsBuckets
+from jsonschema.validators import validator_for
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.attributes import flag_modified
 from werkzeug.local import LocalProxy
 
 from .errors import MergeConflict
 from .fetchers import deposit_fetcher as default_deposit_fetcher
+from .indexer import current_index_queue, deferred_indexing
 from .minters import deposit_minter as default_deposit_minter
+from .proxies import current_schema_map
+from .utils import CopyOnWritePatch
 
 current_jsonschemas = LocalProxy(
     lambda: current_app.extensions['invenio-jsonschemas']
@@ -56,7 +65,12 @@ current_jsonschemas = LocalProxy(
 
 
 def index(method=None, delete=False):
-    """Update index."""
+    """Update index.
+
+    If ``DEPOSIT_DEFERRED_INDEXING`` is enabled or the call happens inside
+    :func:`invenio_deposit.indexer.deferred_indexing`, the record is only
+    queued and sent for bulk indexing once at the end of the request.
+    """
     if method is None:
         return partial(index, delete=delete)
 
@@ -64,9 +78,14 @@ def index(method=None, delete=False):
     def wrapper(self_or_cls, *args, **kwargs):
         """Send record for indexing."""
         result = method(self_or_cls, *args, **kwargs)
+        queue = current_index_queue()
         try:
             if delete:
+                if queue is not None:
+                    queue.discard(result.id)
                 self_or_cls.indexer.delete(result)
+            elif queue is not None:
+                queue.add(self_or_cls.indexer, result)
             else:
                 self_or_cls.indexer.index(result)
         except RequestError:
@@ -109,6 +128,108 @@ def preserve(method=None, result=True, fields=None):
     return wrapper
 
 
+def _defined_in(cls, name):
+    """Return the class defining the attribute ``name`` of ``cls``."""
+    return next(klass for klass in cls.__mro__ if name in vars(klass))
+
+
+_MISSING = object()
+"""Marker of a field missing in a record version."""
+
+
+def _merge_field(key, base, theirs, ours):
+    """Run a three-way merge of one field with :mod:`dictdiffer`."""
+    args = [{key: value} if value is not _MISSING else {}
+            for value in (base, theirs, ours)]
+    m = Merger(*(args + [{}]))
+    try:
+        m.run()
+    except UnresolvedConflictsException:
+        raise MergeConflict()
+    return patch(m.unified_patches, args[0]).get(key, _MISSING)
+
+
+def _merge_value(key, base, theirs, ours):
+    """Merge one field changed since the common revision."""
+    if ours == base:
+        return theirs
+    elif theirs == base or theirs == ours:
+        return ours if ours is _MISSING else deepcopy(ours)
+    elif all(isinstance(value, dict) for value in (base, theirs, ours)):
+        return _merge_dicts(base, theirs, ours)
+    return _merge_field(key, base, theirs, ours)
+
+
+def _merge_dicts(base, theirs, ours, ignore=()):
+    """Merge two dictionaries with their common ancestor field by field.
+
+    Disjoint changes are combined directly, only values modified on both
+    sides are merged with :mod:`dictdiffer`.
+    """
+    merged = {}
+    for key in (set(base) | set(theirs) | set(ours)) - set(ignore):
+        value = _merge_value(key, base.get(key, _MISSING),
+                             theirs.get(key, _MISSING),
+                             ours.get(key, _MISSING))
+        if value is not _MISSING:
+            merged[key] = value
+    return merged
+
+
+_validators = threading.local()
+
+
+def schema_validator(url):
+    """Return a validator for the given schema URL.
+
+    Validators are built once per thread and application; their resolver
+    keeps the resolved references for the following validations.
+    """
+    app = current_app._get_current_object()
+    cache = _validators.__dict__.setdefault('cache', {})
+    try:
+        return cache[app, url]
+    except KeyError:
+        schema = {'$ref': url}
+        resolver = app.extensions['invenio-records'].ref_resolver_cls \
+            .from_schema(schema)
+        validator = cache[app, url] = validator_for(schema)(
+            schema, resolver=resolver)
+        return validator
+
+
+def _validate_pointer(validator, schema, instance, parts):
+    """Validate the part of an instance designated by JSON pointer parts.
+
+    The sub-schema is followed through ``properties``. Arrays, composed
+    schemas and missing targets are validated as a whole from the closest
+    enclosing value, since array indices may shift between patch operations.
+    """
+    if '$ref' in schema:
+        with validator.resolver.resolving(schema['$ref']) as resolved:
+            return _validate_pointer(validator, resolved, instance, parts)
+
+    child = subschema = _MISSING
+    if parts and isinstance(instance, dict) and not any(
+            key in schema for key in ('allOf', 'anyOf', 'oneOf', 'not',
+                                      'dependencies', 'patternProperties')):
+        child = instance.get(parts[0], _MISSING)
+        subschema = schema.get('properties', {}).get(
+            parts[0], schema.get('additionalProperties', {}))
+
+    if child is _MISSING or not isinstance(subschema, dict):
+        for error in validator.iter_errors(instance, schema):
+            raise error
+    else:
+        _validate_pointer(validator, subschema, child, parts[1:])
+
+
+def _pointer_parts(pointer):
+    """Split a JSON pointer into unescaped parts."""
+    return [part.replace('~1', '/').replace('~0', '~')
+            for part in pointer.split('/')[1:]]
+
+
 class Deposit(Record):
     """Define API for changing deposit state."""
 
@@ -124,65 +245,135 @@ class Deposit(Record):
     deposit_minter = staticmethod(default_deposit_minter)
     """Function used to mint the deposit PID."""
 
+    _pid = None
+    """Cached deposit PID."""
+
+    _published = None
+    """Cached published record PID, record and model version keyed by
+    ``_deposit.pid``."""
+
+    _patched_paths = None
+    """JSON pointers changed by the last patch, used for partial validation."""
+
     @property
     def pid(self):
-        """Return an instance of deposit PID."""
+        """Return an instance of deposit PID.
+
+        The PID is fetched from the database only once per instance.
+        """
         pid = self.deposit_fetcher(self.id, self)
-        return PersistentIdentifier.get(pid.pid_type,
-                                        pid.pid_value)
+        if self._pid is None or (self._pid.pid_type, self._pid.pid_value) \
+                != (pid.pid_type, pid.pid_value):
+            self._pid = PersistentIdentifier.get(pid.pid_type,
+                                                 pid.pid_value)
+        return self._pid
 
     @property
     def record_schema(self):
         """Convert deposit schema to a valid record schema."""
-        schema_path = current_jsonschemas.url_to_path(self['$schema'])
-        schema_prefix = current_app.config['DEPOSIT_JSONSCHEMAS_PREFIX']
-        if schema_path and schema_path.startswith(schema_prefix):
-            return current_jsonschemas.path_to_url(
-                schema_path[len(schema_prefix):]
-            )
+        return current_schema_map.record_schema(
+            current_jsonschemas, self['$schema'])
 
     def build_deposit_schema(self, record):
         """Convert record schema to a valid deposit schema."""
-        schema_path = current_jsonschemas.url_to_path(record['$schema'])
-        schema_prefix = current_app.config['DEPOSIT_JSONSCHEMAS_PREFIX']
-        if schema_path:
-            return current_jsonschemas.path_to_url(
-                schema_prefix + schema_path
-            )
+        return current_schema_map.deposit_schema(
+            current_jsonschemas, record['$schema'])
 
     def fetch_published(self):
-        """Return a tuple with PID and published record."""
+        """Return a tuple with PID and published record.
+
+        The result is cached on the instance for the current ``_deposit.pid``.
+        The cached record is rebuilt from its model when the model revision
+        changed, e.g. after the published record was updated.
+        """
         pid_type = self['_deposit']['pid']['type']
         pid_value = self['_deposit']['pid']['value']
 
-        resolver = Resolver(
-            pid_type=pid_type, object_type='rec',
-            getter=partial(self.published_record_class.get_record,
-                           with_deleted=True)
-        )
-        return resolver.resolve(pid_value)
+        if self._published is None or \
+                self._published[0] != (pid_type, pid_value):
+            resolver = Resolver(
+                pid_type=pid_type, object_type='rec',
+                getter=partial(self.published_record_class.get_record,
+                               with_deleted=True)
+            )
+            self._cache_published(*resolver.resolve(pid_value))
+        else:
+            pid, record = self._published[1]
+            if self._published[2] != record.model.version_id:
+                self._cache_published(pid, record.__class__(
+                    record.model.json, model=record.model))
+        return self._published[1]
+
+    def _cache_published(self, pid, record):
+        """Cache the published record PID and record with its revision."""
+        self._published = ((pid.pid_type, pid.pid_value), (pid, record),
+                           record.model.version_id)
 
     @preserve(fields=('_deposit', '$schema'))
     def merge_with_published(self):
-        """Merge changes with latest published version."""
+        """Merge changes with latest published version.
+
+        Changes done on different fields (at any depth) since the last common
+        revision are combined directly; :class:`dictdiffer.merge.Merger` is
+        used only for values modified on both sides.
+        """
         pid, first = self.fetch_published()
         lca = first.revisions[self['_deposit']['pid']['revision_id']]
         # ignore _deposit and $schema field
-        args = [lca.dumps(), first.dumps(), self.dumps()]
-        for arg in args:
-            del arg['$schema'], arg['_deposit']
-        args.append({})
-        m = Merger(*args)
-        try:
-            m.run()
-        except UnresolvedConflictsException:
-            raise MergeConflict()
-        return patch(m.unified_patches, lca)
+        return _merge_dicts(lca, first, self, ignore=('_deposit', '$schema'))
+
+    def validate(self, **kwargs):
+        """Validate the deposit with a cached validator of its schema.
+
+        Drafts are not validated if ``DEPOSIT_VALIDATE_DRAFTS`` is disabled
+        and only their patched fields are validated if
+        ``DEPOSIT_PARTIAL_VALIDATION`` is enabled.
+        """
+        is_draft = self.get('_deposit', {}).get('status') == 'draft'
+        if is_draft and not current_app.config['DEPOSIT_VALIDATE_DRAFTS']:
+            return
+        if kwargs or self.get('$schema') is None:
+            return super(Deposit, self).validate(**kwargs)
+
+        validator = schema_validator(self['$schema'])
+        if is_draft and self._patched_paths is not None and \
+                current_app.config['DEPOSIT_PARTIAL_VALIDATION']:
+            data = dict(self)
+            for path in self._patched_paths:
+                _validate_pointer(validator, validator.schema, data,
+                                  _pointer_parts(path))
+        else:
+            validator.validate(dict(self))
 
     @index
     def commit(self, *args, **kwargs):
         """Store changes on current instance in database."""
-        return super(Deposit, self).commit(*args, **kwargs)
+        result = super(Deposit, self).commit(*args, **kwargs)
+        self._patched_paths = None
+        return result
+
+    @index
+    def commit_files(self):
+        """Store only the ``_files`` section of the deposit.
+
+        Unlike :meth:`commit`, the deposit is neither validated nor sent
+        through the record update signals and other pending changes of the
+        deposit metadata are not stored.
+        """
+        if self.model is None or self.model.json is None:
+            raise MissingModelError()
+
+        with db.session.begin_nested():
+            data = dict(self.model.json)
+            if '_files' in self:
+                data['_files'] = self['_files']
+            else:
+                data.pop('_files', None)
+            self.model.json = data
+
+            flag_modified(self.model, 'json')
+            db.session.merge(self.model)
+        return self
 
     @classmethod
     @index
@@ -206,12 +397,11 @@ class Deposit(Record):
 
         return super(Deposit, cls).create(data, id_=id_)
 
-    def _publish_new(self, id_=None):
-        """Publish new deposit."""
+    def _mint_record_pid(self, id_):
+        """Mint the PID of the published record and store it in the deposit."""
         minter = current_pidstore.minters[
             current_app.config['DEPOSIT_PID_MINTER']
         ]
-        id_ = id_ or uuid.uuid4()
         record_pid = minter(id_, self)
 
         self['_deposit']['pid'] = {
@@ -219,30 +409,38 @@ class Deposit(Record):
             'value': record_pid.pid_value,
             'revision_id': 0,
         }
+        return record_pid
+
+    def _snapshot_bucket(self, data):
+        """Lock the deposit bucket and store the files of its snapshot.
+
+        :returns: The snapshot bucket for the published record.
+        """
+        files = self.files
+        assert not files.bucket.locked
+        files.bucket.locked = True
+        snapshot = files.bucket.snapshot(lock=True)
+        data['_files'] = files.dumps(bucket=snapshot.id)
+        return snapshot
+
+    def _publish_new(self, id_=None):
+        """Publish new deposit."""
+        id_ = id_ or uuid.uuid4()
+        record_pid = self._mint_record_pid(id_)
 
         data = dict(self.dumps())
         data['$schema'] = self.record_schema
 
         # During first publishing create snapshot the bucket.
-        @contextmanager
-        def process_files(data):
-            """Process deposit files."""
-            if RecordsBuckets.query.filter_by(
-                    record_id=self.model.id).count():
-                assert not self.files.bucket.locked
-                self.files.bucket.locked = True
-                snapshot = self.files.bucket.snapshot(lock=True)
-                data['_files'] = self.files.dumps(bucket=snapshot.id)
-                yield data
-                db.session.add(RecordsBuckets(
-                    record_id=id_, bucket_id=snapshot.id
-                ))
-            else:
-                yield data
-
-        with process_files(data) as data:
-            record = self.published_record_class.create(data,
-                                                        id_=id_)
+        snapshot = None
+        if RecordsBuckets.query.filter_by(record_id=self.model.id).count():
+            snapshot = self._snapshot_bucket(data)
+        record = self.published_record_class.create(data, id_=id_)
+        if snapshot is not None:
+            db.session.add(RecordsBuckets(
+                record_id=id_, bucket_id=snapshot.id
+            ))
+        self._cache_published(record_pid, record)
         return record
 
     def _publish_edited(self):
@@ -256,6 +454,7 @@ class Deposit(Record):
         data['$schema'] = self.record_schema
         data['_deposit'] = self['_deposit']
         record = record.__class__(data, model=record.model)
+        self._cache_published(record_pid, record)
         return record
 
     # No need for indexing as it calls self.commit()
@@ -277,6 +476,149 @@ class Deposit(Record):
         self.commit()
         return self
 
+    @classmethod
+    def publish_many(cls, deposits):
+        """Publish several deposits at once.
+
+        The deposit PIDs are fetched with one query per PID type. The
+        deposits published for the first time are processed as a batch: their
+        published records are inserted and the deposits updated in a single
+        flush. Deposits of classes customizing the publishing are left out of
+        the batch. If the batch fails, it is rolled back and its deposits are
+        published one by one, like the deposits which have been published
+        before, each in its own savepoint, so that a failure only rolls back
+        the deposit which caused it. The deposits and their published records
+        are sent for indexing in a single bulk request.
+
+        :param deposits: Iterable of deposits.
+        :returns: A tuple with the list of published deposits and a list of
+            ``(deposit, exception)`` pairs for the deposits which failed.
+        """
+        deposits = list(deposits)
+        cls._prefetch_pids(deposits)
+
+        published, failed = [], []
+        batch, pending = [], []
+        for deposit in deposits:
+            if 'draft' != deposit['_deposit']['status'] or \
+                    not deposit.pid.is_registered():
+                failed.append((deposit, PIDInvalidAction()))
+            elif deposit['_deposit'].get('pid') is None and \
+                    deposit._can_publish_in_batch():
+                batch.append(deposit)
+            else:
+                pending.append(deposit)
+
+        with deferred_indexing() as queue:
+            if batch:
+                states = [(deepcopy(deposit['_deposit']), deposit._published)
+                          for deposit in batch]
+                try:
+                    with db.session.begin_nested():
+                        records = cls._publish_new_batch(batch)
+                except Exception:
+                    current_app.logger.warning(
+                        'Could not publish the deposits in a batch.',
+                        exc_info=True)
+                    for deposit, state in zip(batch, states):
+                        deposit['_deposit'], deposit._published = state
+                    pending = batch + pending
+                else:
+                    for deposit, record in zip(batch, records):
+                        after_record_insert.send(record)
+                        after_record_update.send(deposit)
+                        published.append(deposit)
+                        queue.add(cls.indexer, deposit)
+                        queue.add(cls.indexer, record)
+
+            for deposit in pending:
+                state = deepcopy(deposit['_deposit']), deposit._published
+                try:
+                    with db.session.begin_nested():
+                        deposit.publish()
+                except Exception as exc:
+                    deposit['_deposit'], deposit._published = state
+                    current_app.logger.warning(
+                        'Could not publish {0}.'.format(deposit.id),
+                        exc_info=True)
+                    failed.append((deposit, exc))
+                else:
+                    published.append(deposit)
+                    _, record = deposit._published[1]
+                    queue.add(cls.indexer, record)
+        return published, failed
+
+    def _can_publish_in_batch(self):
+        """Check that publishing does not depend on overridden methods.
+
+        The batch publishing bypasses :meth:`publish`, :meth:`_publish_new`,
+        :meth:`commit` and the ``create`` method of the published record
+        class, so it is only used when none of them is customized.
+        """
+        return all(_defined_in(self.__class__, name) is Deposit
+                   for name in ('publish', '_publish_new', 'commit')) and \
+            _defined_in(self.published_record_class, 'create') is \
+            _defined_in(Record, 'create')
+
+    @classmethod
+    def _publish_new_batch(cls, deposits):
+        """Publish new deposits inserting their records in a single flush.
+
+        The record PIDs are minted and the buckets snapshotted first, as both
+        flush the session, then the records, their buckets and the updated
+        deposits are stored together.
+        """
+        with_bucket = set(record_id for record_id, in db.session.query(
+            RecordsBuckets.record_id).filter(RecordsBuckets.record_id.in_(
+                [deposit.id for deposit in deposits])))
+
+        records, buckets = [], []
+        for deposit in deposits:
+            deposit['_deposit']['status'] = 'published'
+            id_ = uuid.uuid4()
+            record_pid = deposit._mint_record_pid(id_)
+
+            data = dict(deposit.dumps())
+            data['$schema'] = deposit.record_schema
+            if deposit.id in with_bucket:
+                snapshot = deposit._snapshot_bucket(data)
+                buckets.append(RecordsBuckets(
+                    record_id=id_, bucket_id=snapshot.id
+                ))
+
+            record = deposit.published_record_class(data)
+            before_record_insert.send(record)
+            record.validate()
+            record.model = RecordMetadata(id=id_, json=record)
+            deposit._cache_published(record_pid, record)
+            records.append(record)
+
+        for deposit in deposits:
+            before_record_update.send(deposit)
+            deposit.validate()
+            deposit.model.json = dict(deposit)
+            flag_modified(deposit.model, 'json')
+            deposit._patched_paths = None
+
+        db.session.add_all([record.model for record in records])
+        db.session.add_all(buckets)
+        db.session.flush()
+        return records
+
+    @staticmethod
+    def _prefetch_pids(deposits):
+        """Load the PIDs of the given deposits in bulk."""
+        by_type = {}
+        for deposit in deposits:
+            if deposit._pid is None:
+                pid = deposit.deposit_fetcher(deposit.id, deposit)
+                by_type.setdefault(pid.pid_type, {})[pid.pid_value] = deposit
+        for pid_type, values in by_type.items():
+            for pid in PersistentIdentifier.query.filter(
+                    PersistentIdentifier.pid_type == pid_type,
+                    PersistentIdentifier.pid_value.in_(list(values))):
+                values[pid.pid_value]._pid = pid
+
     def _prepare_edit(self, record):
         """Update selected keys."""
         data = record.dumps()
@@ -305,7 +647,9 @@ class Deposit(Record):
             db.session.merge(self.model)
 
         after_record_update.send(self)
-        return self.__class__(self.model.json, model=self.model)
+        deposit = self.__class__(self.model.json, model=self.model)
+        deposit._pid, deposit._published = self._pid, self._published
+        return deposit
 
     @has_status
     @index
@@ -325,7 +669,9 @@ class Deposit(Record):
             db.session.merge(self.model)
 
         after_record_update.send(self)
-        return self.__class__(self.model.json, model=self.model)
+        deposit = self.__class__(self.model.json, model=self.model)
+        deposit._pid, deposit._published = self._pid, self._published
+        return deposit
 
     @has_status
     @index(delete=True)
@@ -352,10 +698,22 @@ class Deposit(Record):
         super(Deposit, self).update(*args, **kwargs)
 
     @has_status
-    @preserve
-    def patch(self, *args, **kwargs):
-        """Patch only drafts."""
-        return super(Deposit, self).patch(*args, **kwargs)
+    def patch(self, patch):
+        """Patch only drafts.
+
+        Only the parts of the deposit changed by the operations are copied and
+        operations changing ``_deposit`` are rejected. The changed paths are
+        remembered for partial validation on the next commit of the returned
+        deposit.
+        """
+        data = CopyOnWritePatch(patch, protected=('_deposit', )).apply(self)
+        result = self.__class__(data, model=self.model)
+        result._patched_paths = [
+            path for operation in patch
+            for path in (operation['path'], operation.get('from'))
+            if path is not None
+        ]
+        return result
 
     def _create_bucket(self):
         """Override bucket creation."""
@@ -363,12 +721,52 @@ class Deposit(Record):
             'DEPOSIT_DEFAULT_STORAGE_CLASS'
         ])
 
+    def file_objects(self, after=None, size=None, chunk_size=500):
+        """Iterate over the objects of the deposit files.
+
+        The file instances are loaded eagerly with the objects, which are
+        fetched from the database in chunks. Without arguments the objects
+        follow the order defined in ``_files``, otherwise they are ordered by
+        key, starting after the key ``after`` and limited to ``size`` objects
+        (keyset pagination).
+        """
+        files = self.files
+        if files is None:
+            return
+
+        query = ObjectVersion.query.options(
+            joinedload(ObjectVersion.file)
+        ).filter(
+            ObjectVersion.bucket_id == files.bucket.id,
+            ObjectVersion.is_head.is_(True),
+            ObjectVersion.file_id.isnot(None),
+        )
+
+        if after is not None or size is not None:
+            query = query.order_by(ObjectVersion.key)
+            if after:
+                query = query.filter(ObjectVersion.key > after)
+            if size is not None:
+                query = query.limit(size)
+            for obj in query.yield_per(chunk_size):
+                yield obj
+            return
+
+        keys = [file_['key'] for file_ in self.get('_files', [])]
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            objs = dict((obj.key, obj) for obj in query.filter(
+                ObjectVersion.key.in_(chunk)))
+            for key in chunk:
+                if key in objs:
+                    yield objs[key]
+
     @property
     def files(self):
         """Add validation on ``sort_by`` method."""
         files_ = super(Deposit, self).files
 
-        if files_:
+        if files_ is not None:
             sort_by_ = files_.sort_by
 
             def sort_by(*args, **kwargs):
@@ -26,12 +26,32 @@
 
 from __future__ import absolute_import, print_function
 
+import json
+import os
+import posixpath
+import re
 import sys
+import time
+from copy import deepcopy
+from functools import wraps
+from itertools import chain
+from multiprocessing import Pool
 
 import click
 from flask import current_app
 from flask_cli import with_appcontext
+from invenio_db import db
+from invenio_indexer.utils import schema_to_index
 from invenio_pidstore import current_pidstore
+from invenio_pidstore.models import PersistentIdentifier
+from invenio_search import current_search
+from sqlalchemy.orm.exc import StaleDataError
+
+from .api import Deposit
+from .indexer import deferred_indexing
+from .providers import DepositProvider
+from .search import DepositSearch
+from .signals import post_action
 
 
 def process_minter(value):
@@ -59,6 +79,99 @@ def process_schema(value):
         )
 
 
+_JSON_DELIMITERS = re.compile(r'["\\\[\]{},]')
+"""Characters changing the nesting, strings or items of a JSON array."""
+
+_JSON_OPENING = {']': '[', '}': '{'}
+"""Opening bracket of each closing bracket."""
+
+
+def iter_json_array(source, chunk_size=64 * 1024):
+    """Iterate over the texts of the items of a JSON array.
+
+    The opening bracket must have been read already. The nesting and the
+    strings are tracked to find where each item ends, so that it can be
+    decoded as soon as it is complete.
+    """
+    item, nesting, in_string, escape = [], [], False, False
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            raise click.BadParameter('Unexpected end of JSON array.')
+        start, skip, escape = 0, int(escape), False
+        for match in _JSON_DELIMITERS.finditer(chunk, skip):
+            index = match.start()
+            if index < skip:
+                continue
+            char = match.group()
+            if in_string:
+                if char == '\\':
+                    skip = index + 2
+                    escape = skip > len(chunk)
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '[{':
+                nesting.append(char)
+            elif char in ']}' and nesting:
+                if nesting.pop() != _JSON_OPENING[char]:
+                    raise click.BadParameter('Mismatched JSON brackets.')
+            elif nesting:
+                continue
+            elif char not in ',]':
+                raise click.BadParameter('Invalid JSON array.')
+            else:
+                item.append(chunk[start:index])
+                text = ''.join(item).strip()
+                item, start = [], index + 1
+                if text:
+                    yield text
+                elif char == ',':
+                    raise click.BadParameter('Missing JSON array item.')
+                if char == ']':
+                    return
+        item.append(chunk[start:])
+
+
+def iter_json(source, chunk_size=64 * 1024):
+    """Iterate over the objects of a JSON array or of JSON lines.
+
+    The source is read incrementally, so only the object being decoded is
+    kept in memory. A malformed object is reported as soon as it is read.
+    """
+    first = source.read(1)
+    while first.isspace():
+        first = source.read(1)
+    if not first:
+        return
+
+    if first != '[':
+        for line in chain([first + source.readline()], source):
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    for text in iter_json_array(source, chunk_size=chunk_size):
+        try:
+            yield json.loads(text)
+        except ValueError as exc:
+            raise click.BadParameter(
+                'Invalid JSON array item: {0}'.format(exc))
+
+
+def iter_batches(iterable, size):
+    """Split an iterable in lists of given size."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 #
 # Deposit management commands
 #
@@ -67,37 +180,298 @@ def deposit():
     """Deposit management commands."""
 
 
+def rebase_ref(ref, source, target):
+    """Rewrite a relative reference from one schema directory to another."""
+    if '://' in ref or ref.startswith(('#', '/')):
+        return ref
+    path, hash_, fragment = ref.partition('#')
+    path = posixpath.relpath(
+        posixpath.normpath(posixpath.join(source, path)), target or '.')
+    return path + hash_ + fragment
+
+
+def rebase_refs(schema, source, target):
+    """Make the relative references of a schema valid from ``target``."""
+    if isinstance(schema, dict):
+        return {
+            key: rebase_ref(value, source, target) if key == '$ref'
+            else rebase_refs(value, source, target)
+            for key, value in schema.items()
+        }
+    if isinstance(schema, list):
+        return [rebase_refs(value, source, target) for value in schema]
+    return schema
+
+
+def make_deposit_schema(schema, template):
+    """Add the deposit fields of the template to a record schema."""
+    schema = deepcopy(schema)
+    properties = schema.setdefault('properties', {})
+    for key, value in template['properties'].items():
+        properties.setdefault(key, deepcopy(value))
+    required = schema.setdefault('required', [])
+    for key in template.get('required', []):
+        if key not in required:
+            required.append(key)
+    return schema
+
+
+def make_deposit_mapping(mapping, template, doc_type):
+    """Add the deposit fields of the template to a record mapping."""
+    fields = next(iter(template['mappings'].values()))['properties']
+    result = deepcopy(mapping)
+    result['mappings'] = {}
+    for value in mapping.get('mappings', {}).values():
+        value = deepcopy(value)
+        properties = value.setdefault('properties', {})
+        for key, field in fields.items():
+            properties.setdefault(key, deepcopy(field))
+        result['mappings'][doc_type] = value
+    return result
+
+
+def write_json(path, data):
+    """Write JSON data to a file creating missing directories."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+
+
+def load_mapping(path):
+    """Load the search mapping of a schema if there is one."""
+    index, _ = schema_to_index(path, index_names=current_search.mappings)
+    if index is not None:
+        with open(current_search.mappings[index]) as fp:
+            return json.load(fp)
+
+
 @deposit.command()
-@click.argument('source')
+@click.argument('sources', nargs=-1)
+@click.option('-o', '--output', required=True,
+              type=click.Path(file_okay=False, writable=True),
+              help='Directory receiving jsonschemas/ and mappings/.')
 @with_appcontext
-def schema(source):
-    """Create deposit schema from an existing schema."""
-    click.echo(process_schema(source))
-    # TODO
+def schema(sources, output):
+    """Create deposit schemas and mappings from existing record schemas.
+
+    Without arguments all registered record schemas are converted. The
+    files are written under the ``DEPOSIT_JSONSCHEMAS_PREFIX`` directory so
+    that they can be registered as they are.
+    """
+    jsonschemas = current_app.extensions['invenio-jsonschemas']
+    prefix = current_app.config['DEPOSIT_JSONSCHEMAS_PREFIX']
+    template = current_app.config['DEPOSIT_DEFAULT_JSONSCHEMA']
+    schema_template = jsonschemas.get_schema(template)
+    mapping_template = load_mapping(template)
+
+    for path in sources:
+        process_schema(path)
+    sources = sources or sorted(
+        path for path in jsonschemas.list_schemas()
+        if not path.startswith(prefix)
+    )
+
+    for path in sources:
+        deposit_path = prefix + path
+        target = posixpath.dirname(deposit_path)
+        write_json(
+            os.path.join(output, 'jsonschemas', deposit_path),
+            make_deposit_schema(
+                rebase_refs(jsonschemas.get_schema(path),
+                            posixpath.dirname(path), target),
+                rebase_refs(schema_template,
+                            posixpath.dirname(template), target)))
+        click.echo('jsonschemas/{0}'.format(deposit_path))
+
+        mapping = load_mapping(path)
+        if mapping is not None and mapping_template is not None:
+            write_json(
+                os.path.join(output, 'mappings', deposit_path),
+                make_deposit_mapping(
+                    mapping, mapping_template,
+                    os.path.splitext(os.path.basename(path))[0]))
+            click.echo('mappings/{0}'.format(deposit_path))
 
 
 @deposit.command()
 @click.argument('source', type=click.File('r'), default=sys.stdin)
-@click.option('-i', '--id', 'ids', multiple=True)
-@click.option('--force', is_flag=True, default=False)
+@click.option('-u', '--uuid', 'uuids', multiple=True,
+              help='Record UUID of a deposit, in input order.')
+@click.option('--force', is_flag=True, default=False,
+              help='Skip invalid deposits instead of aborting.')
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=1000,
+              help='Number of deposits stored per transaction.')
 @with_appcontext
-def create(source, ids, force, pid_minter=None):
-    """Create new deposit."""
+def create(source, uuids, force, batch_size):
+    """Create new deposits from a JSON array or JSON lines.
 
+    The optional record UUIDs are assigned to the deposits in order. Unlike
+    the ``--id`` option of the other commands, they are not deposit PID
+    values, which are minted for the new deposits.
+    """
+    ids = iter(uuids)
+    created = failed = 0
+    start = time.time()
+    for batch in iter_batches(iter_json(source), batch_size):
+        with deferred_indexing():
+            for data in batch:
+                try:
+                    with db.session.begin_nested():
+                        Deposit.create(data, id_=next(ids, None))
+                    created += 1
+                except Exception as exc:
+                    if not force:
+                        db.session.rollback()
+                        raise click.ClickException(
+                            'Could not create deposit #{0}: {1}'.format(
+                                created + failed + 1, exc))
+                    failed += 1
+                    click.secho('Skipping deposit #{0}: {1}'.format(
+                        created + failed, exc), fg='yellow', err=True)
+            db.session.commit()
+        db.session.expunge_all()
+        click.echo('Created {0} deposits ({1:.1f}/s).'.format(
+            created, created / max(time.time() - start, 1e-6)), err=True)
 
-@deposit.command()
-@click.option('-i', '--id', 'ids', multiple=True)
-def publish(ids):
+    if failed:
+        click.secho('Skipped {0} deposits.'.format(failed), fg='yellow',
+                    err=True)
+
+
+def iter_deposit_ids(ids, query):
+    """Iterate over deposit UUIDs given by PID values or a search query."""
+    for chunk in iter_batches(ids, 500):
+        for pid in PersistentIdentifier.query.filter(
+                PersistentIdentifier.pid_type == DepositProvider.pid_type,
+                PersistentIdentifier.pid_value.in_(chunk)):
+            yield str(pid.object_uuid)
+    if query is not None:
+        search = DepositSearch().query('query_string', query=query)
+        for hit in search.source(False).scan():
+            yield hit.meta.id
+
+
+def process_chunk(action, ids, retries=3):
+    """Run a deposit action on a chunk of deposits in one transaction.
+
+    Every deposit runs in its own savepoint and is retried with fresh data
+    when it was modified concurrently.
+
+    :returns: A tuple with the number of processed deposits and a list of
+        ``(id, error)`` pairs.
+    """
+    app = current_app._get_current_object()
+    done, failed = 0, []
+    with deferred_indexing():
+        for id_ in ids:
+            for attempt in range(retries + 1):
+                try:
+                    with db.session.begin_nested():
+                        deposit = Deposit.get_record(id_)
+                        deposit = getattr(deposit, action)() or deposit
+                        post_action.send(app, action=action,
+                                         pid=deposit.pid, deposit=deposit)
+                    done += 1
+                    break
+                except StaleDataError as exc:
+                    if attempt == retries:
+                        failed.append((id_, str(exc)))
+                except Exception as exc:
+                    failed.append((id_, str(exc)))
+                    break
+        db.session.commit()
+    db.session.expunge_all()
+    return done, failed
+
+
+_worker_app = None
+"""Application used by the worker processes."""
+
+
+def _init_worker(app):
+    """Initialize a worker process with its own database connections."""
+    global _worker_app
+    _worker_app = app
+    with app.app_context():
+        db.engine.dispose()
+
+
+def _process_chunk(args):
+    """Process a chunk of deposits in a worker process."""
+    with _worker_app.app_context():
+        return process_chunk(*args)
+
+
+def run_action(action, ids, query, jobs, chunk_size, retries):
+    """Run an action on the selected deposits and print a summary."""
+    chunks = (
+        (action, chunk, retries)
+        for chunk in iter_batches(iter_deposit_ids(ids, query), chunk_size)
+    )
+    if jobs > 1:
+        db.engine.dispose()
+        pool = Pool(jobs, _init_worker, (current_app._get_current_object(),))
+        results = pool.imap_unordered(_process_chunk, chunks)
+    else:
+        pool = None
+        results = (process_chunk(*args) for args in chunks)
+
+    done, failed = 0, []
+    start = time.time()
+    try:
+        for chunk_done, chunk_failed in results:
+            done += chunk_done
+            failed.extend(chunk_failed)
+            rate = (done + len(failed)) / max(time.time() - start, 1e-6)
+            click.echo('Processed {0} deposits ({1:.1f}/s).'.format(
+                done + len(failed), rate), err=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for id_, error in failed:
+        click.secho('{0}: {1}'.format(id_, error), fg='red', err=True)
+    click.echo('{0}: {1} succeeded, {2} failed.'.format(
+        action.capitalize(), done, len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+def action_command(f):
+    """Add the deposit selection and processing options to a command."""
+    @deposit.command(f.__name__)
+    @click.option('-i', '--id', 'ids', multiple=True,
+                  help='Deposit PID value.')
+    @click.option('-q', '--query', default=None,
+                  help='Select the deposits matching a search query.')
+    @click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+                  help='Number of worker processes.')
+    @click.option('-c', '--chunk-size', type=click.IntRange(min=1),
+                  default=100, help='Number of deposits per transaction.')
+    @click.option('-r', '--retries', type=click.IntRange(min=0), default=3,
+                  help='Number of retries on concurrent modification.')
+    @with_appcontext
+    @wraps(f)
+    def command(ids, query, **kwargs):
+        if not ids and query is None:
+            raise click.UsageError('Select deposits with --id or --query.')
+        run_action(f.__name__, ids, query, **kwargs)
+    return command
+
+
+@action_command
+def publish():
     """Publish selected deposits."""
 
 
-@deposit.command()
-@click.option('-i', '--id', 'ids', multiple=True)
-def edit(ids):
+@action_command
+def edit():
     """Make selected deposits editable."""
 
 
-@deposit.command()
-@click.option('-i', '--id', 'ids', multiple=True)
-def discard(ids):
+@action_command
+def discard():
     """Discard selected deposits."""
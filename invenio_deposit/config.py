@@ -24,11 +24,12 @@
 
 """Default configuration of deposit module."""
 
+from datetime import timedelta
+
 from invenio_records_rest.facets import terms_filter
-from invenio_records_rest.utils import check_elasticsearch
 
-from .utils import check_oauth2_scope_write, \
-    check_oauth2_scope_write_elasticsearch
+from .utils import check_oauth2_scope_write, check_oauth2_scope_write_owner, \
+    check_owner
 
 DEPOSIT_SEARCH_API = '/api/deposits'
 """URL of search endpoint for deposits."""
@@ -59,6 +60,8 @@ DEPOSIT_REST_ENDPOINTS = dict(
         files_serializers={
             'application/json': ('invenio_deposit.serializers'
                                  ':json_v1_files_response'),
+            'application/x-ndjson': ('invenio_deposit.serializers'
+                                     ':ndjson_v1_files_response'),
         },
         record_serializers={
             'application/json': ('invenio_records_rest.serializers'
@@ -77,9 +80,9 @@ DEPOSIT_REST_ENDPOINTS = dict(
         default_media_type='application/json',
         links_factory_imp='invenio_deposit.links:deposit_links_factory',
         create_permission_factory_imp=check_oauth2_scope_write,
-        read_permission_factory_imp=check_elasticsearch,
-        update_permission_factory_imp=check_oauth2_scope_write_elasticsearch,
-        delete_permission_factory_imp=check_oauth2_scope_write_elasticsearch,
+        read_permission_factory_imp=check_owner,
+        update_permission_factory_imp=check_oauth2_scope_write_owner,
+        delete_permission_factory_imp=check_oauth2_scope_write_owner,
         max_result_window=10000,
     ),
 )
@@ -150,3 +153,45 @@ DEPOSIT_DEFAULT_STORAGE_CLASS = 'S'
 
 DEPOSIT_REGISTER_SIGNALS = True
 """Enable the signals registration."""
+
+DEPOSIT_PERMISSION_ELASTICSEARCH_FALLBACK = False
+"""Check records without ``_deposit.owners`` against Elasticsearch."""
+
+DEPOSIT_DEFERRED_INDEXING = False
+"""Queue deposits for bulk indexing at the end of the request.
+
+If enabled, every deposit modified during a request is sent only once to the
+bulk indexing queue when the request finishes, instead of being indexed
+synchronously on each change.
+"""
+
+DEPOSIT_VALIDATE_DRAFTS = True
+"""Validate drafts every time they are stored.
+
+If disabled, drafts are stored without validation and a deposit is only
+validated against its schema when it is published.
+"""
+
+DEPOSIT_PARTIAL_VALIDATION = False
+"""Validate only the fields changed by a JSON Patch when storing a draft.
+
+The whole deposit is still validated when it is published.
+"""
+
+DEPOSIT_ASYNC_PUBLISH = False
+"""Publish deposits in a background task.
+
+If enabled, the publish action answers with 202 and a job, whose status can
+be followed at the ``Location`` of the response.
+"""
+
+DEPOSIT_FILES_MAX_PAGE_SIZE = 1000
+"""Maximum number of files returned in one page of the files listing."""
+
+DEPOSIT_MULTIPART_UPLOAD_EXPIRES = timedelta(days=7)
+"""Time after which an unfinished multipart upload is removed.
+
+The expired uploads are removed by the
+:func:`invenio_deposit.tasks.delete_expired_uploads` task, which should be
+scheduled periodically, e.g. with Celery beat.
+"""
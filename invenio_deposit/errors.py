@@ -43,6 +43,13 @@ class WrongFile(RESTException):
     description = 'Wrong file on input.'
 
 
+class WrongPartNumber(RESTException):
+    """Error wrong part number of a multipart upload."""
+
+    code = 400
+    description = 'Part number must be a positive integer.'
+
+
 class MergeConflict(RESTException):
     """Error on merging a deposit."""
 
@@ -28,14 +28,31 @@ from __future__ import absolute_import, print_function
 
 from . import config
 from .cli import deposit as cmd
+from .indexer import flush_index_queue
+from .permissions import load_permission_class
 from .receivers import index_deposit_after_publish
 from .signals import post_action
+from .utils import SchemaMap
 from .views import rest, ui
 
 
+def load_schema_map(app):
+    """Build the deposit schema map from the registered JSON schemas."""
+    schema_map = SchemaMap(app.config['DEPOSIT_JSONSCHEMAS_PREFIX'])
+    if 'invenio-jsonschemas' in app.extensions:
+        schema_map.load(app.extensions['invenio-jsonschemas'])
+    return schema_map
+
+
 class InvenioDeposit(object):
     """Invenio-Deposit extension."""
 
+    permission_class = None
+    """Permission class used for the admin permission."""
+
+    schema_map = None
+    """Map between deposit and record schema URLs."""
+
     def __init__(self, app=None):
         """Extension initialization."""
         if app:
@@ -48,7 +65,10 @@ class InvenioDeposit(object):
         app.register_blueprint(ui.create_blueprint(
             app.config['DEPOSIT_RECORDS_UI_ENDPOINTS']
         ))
+        self.permission_class = load_permission_class()
+        self.schema_map = load_schema_map(app)
         app.extensions['invenio-deposit'] = self
+        app.teardown_request(flush_index_queue)
         if app.config['DEPOSIT_REGISTER_SIGNALS']:
             post_action.connect(index_deposit_after_publish, sender=app,
                                 weak=False)
@@ -67,6 +87,12 @@ class InvenioDeposit(object):
 class InvenioDepositREST(object):
     """Invenio-Deposit REST extension."""
 
+    permission_class = None
+    """Permission class used for the admin permission."""
+
+    schema_map = None
+    """Map between deposit and record schema URLs."""
+
     def __init__(self, app=None):
         """Extension initialization."""
         if app:
@@ -78,7 +104,10 @@ class InvenioDepositREST(object):
         app.register_blueprint(rest.create_blueprint(
             app.config['DEPOSIT_REST_ENDPOINTS']
         ))
+        self.permission_class = load_permission_class()
+        self.schema_map = load_schema_map(app)
         app.extensions['invenio-deposit-rest'] = self
+        app.teardown_request(flush_index_queue)
         if app.config['DEPOSIT_REGISTER_SIGNALS']:
             post_action.connect(index_deposit_after_publish, sender=app,
                                 weak=False)
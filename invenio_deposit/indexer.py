@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Deferred indexing of deposits."""
+
+from __future__ import absolute_import, print_function
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from elasticsearch.exceptions import RequestError
+from flask import current_app, g, has_request_context
+from invenio_indexer.tasks import process_bulk_queue
+
+
+class IndexQueue(object):
+    """Coalesce index requests and send each record once.
+
+    Each record is tracked together with the indexer responsible for it and
+    the last seen revision, so that it is sent exactly once no matter how
+    many times it was requested during the request. The records are either
+    sent to the bulk indexing queue or indexed directly when the queue is
+    flushed.
+    """
+
+    def __init__(self, bulk=True):
+        """Initialize an empty queue.
+
+        :param bulk: Send the records to the bulk indexing queue instead of
+            indexing them directly.
+        """
+        self.bulk = bulk
+        self._pending = OrderedDict()
+        self.requested = 0
+        """Number of index operations requested."""
+        self.sent = 0
+        """Number of index operations sent to the indexer."""
+        self.revisions = {}
+        """Last revision sent to the indexer for each record id."""
+
+    def __len__(self):
+        """Return number of distinct queued records."""
+        return len(self._pending)
+
+    def __contains__(self, record_id):
+        """Check if the record is queued for indexing."""
+        record_id = str(record_id)
+        return any(key[1] == record_id for key in self._pending)
+
+    @property
+    def saved(self):
+        """Number of index operations avoided by coalescing."""
+        return self.requested - self.sent - len(self)
+
+    def add(self, indexer, record):
+        """Queue the current revision of a record with the given indexer."""
+        self.requested += 1
+        key = (indexer, str(record.id))
+        revision_id = record.revision_id
+        queued = self._pending.get(key)
+        if queued is None or revision_id is None or \
+                revision_id >= (queued[1] or -1):
+            self._pending[key] = (record, revision_id)
+
+    def discard(self, record_id):
+        """Remove a record from the queue (e.g. after it was deleted)."""
+        record_id = str(record_id)
+        for key in [key for key in self._pending if key[1] == record_id]:
+            del self._pending[key]
+
+    def flush(self):
+        """Send all queued records to the indexer."""
+        batches = OrderedDict()
+        revisions = {}
+        for (indexer, record_id), (record, revision_id) in \
+                self._pending.items():
+            batches.setdefault(indexer, []).append(record)
+            revisions[record_id] = revision_id
+        self._pending = OrderedDict()
+
+        for indexer, records in batches.items():
+            if self.bulk:
+                indexer.bulk_index([str(record.id) for record in records])
+            else:
+                for record in records:
+                    try:
+                        indexer.index(record)
+                    except RequestError:
+                        current_app.logger.exception(
+                            'Could not index {0}.'.format(record))
+            self.sent += len(records)
+        if batches:
+            self.revisions.update(revisions)
+            if self.bulk:
+                process_bulk_queue.delay()
+            current_app.logger.debug(
+                'Sent {0} records for indexing ({1} requests coalesced): {2}.'
+                .format(self.sent, self.saved, ', '.join(
+                    '{0}@{1}'.format(record_id, revision_id)
+                    for record_id, revision_id in revisions.items())))
+
+
+def current_index_queue():
+    """Return the active index queue or ``None`` for immediate indexing."""
+    queue = getattr(g, '_deposit_index_queue', None)
+    if queue is None and has_request_context() and \
+            current_app.config['DEPOSIT_DEFERRED_INDEXING']:
+        queue = g._deposit_index_queue = IndexQueue()
+    return queue
+
+
+@contextmanager
+def deferred_indexing(bulk=True):
+    """Defer indexing of deposits until the end of the block.
+
+    :param bulk: Send the records to the bulk indexing queue, otherwise they
+        are indexed directly at the end of the block. It has no effect inside
+        an already active queue.
+
+    .. code-block:: python
+
+        with deferred_indexing():
+            for data in records:
+                Deposit.create(data)
+            db.session.commit()
+    """
+    queue = getattr(g, '_deposit_index_queue', None)
+    if queue is not None:
+        yield queue
+        return
+
+    queue = g._deposit_index_queue = IndexQueue(bulk=bulk)
+    try:
+        yield queue
+        queue.flush()
+    finally:
+        del g._deposit_index_queue
+
+
+def flush_index_queue(exception=None):
+    """Flush the index queue at the end of a request.
+
+    The queue is discarded if the request failed, as its changes were not
+    committed.
+    """
+    queue = getattr(g, '_deposit_index_queue', None)
+    if queue is None:
+        return
+    del g._deposit_index_queue
+    if exception is not None:
+        return
+    try:
+        queue.flush()
+    except Exception:
+        current_app.logger.exception('Could not flush the index queue.')
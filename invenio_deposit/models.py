@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Deposit models."""
+
+from __future__ import absolute_import, print_function
+
+import uuid
+from datetime import datetime
+
+from invenio_db import db
+from invenio_files_rest.models import Bucket, ObjectVersion
+from invenio_files_rest.tasks import remove_file_data
+from invenio_records.models import RecordMetadata
+from sqlalchemy_utils.models import Timestamp
+from sqlalchemy_utils.types import UUIDType
+
+from .utils import ChainedStream
+
+
+class MultipartUpload(db.Model, Timestamp):
+    """Resumable upload of a deposit file sent in several parts.
+
+    Parts are stored as objects of a dedicated bucket, keyed by their part
+    number, until the upload is completed and the parts are concatenated into
+    the deposit bucket.
+    """
+
+    __tablename__ = 'deposit_multipart_upload'
+
+    id = db.Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    """Upload identifier."""
+
+    record_id = db.Column(
+        UUIDType, db.ForeignKey(RecordMetadata.id), nullable=False)
+    """Deposit receiving the file."""
+
+    key = db.Column(db.Text, nullable=False)
+    """Key of the file in the deposit bucket."""
+
+    bucket_id = db.Column(
+        UUIDType, db.ForeignKey(Bucket.id), nullable=False)
+    """Bucket holding the uploaded parts."""
+
+    bucket = db.relationship(Bucket)
+
+    @classmethod
+    def create(cls, record, key):
+        """Start a new upload of ``key`` to the given deposit."""
+        with db.session.begin_nested():
+            upload = cls(record_id=record.id, key=key,
+                         bucket=record._create_bucket())
+            db.session.add(upload)
+        return upload
+
+    @classmethod
+    def get(cls, record, upload_id):
+        """Get an upload of the given deposit."""
+        return cls.query.filter_by(id=upload_id, record_id=record.id).first()
+
+    @property
+    def parts(self):
+        """Return the latest version of each part ordered by part number."""
+        return sorted(
+            ObjectVersion.query.filter_by(
+                bucket_id=self.bucket_id, is_head=True).all(),
+            key=lambda obj: int(obj.key)
+        )
+
+    def set_part(self, part_number, stream):
+        """Store the content of a part."""
+        self.updated = datetime.utcnow()
+        return ObjectVersion.create(self.bucket, str(part_number),
+                                    stream=stream)
+
+    def open(self):
+        """Return a stream reading all parts in order."""
+        return ChainedStream(
+            obj.file.storage().open() for obj in self.parts
+        )
+
+    def delete(self):
+        """Remove the upload with the versions of its parts and its bucket.
+
+        The file instances of the parts are kept, as their data must only be
+        removed once the transaction is committed with :meth:`remove_files`.
+
+        :returns: The ids of the file instances of the parts.
+        """
+        with db.session.begin_nested():
+            bucket = self.bucket
+            objs = ObjectVersion.query.filter_by(bucket_id=bucket.id).all()
+            file_ids = [obj.file_id for obj in objs
+                        if obj.file_id is not None]
+            for obj in objs:
+                db.session.delete(obj)
+            db.session.delete(self)
+            db.session.delete(bucket)
+        return file_ids
+
+    @staticmethod
+    def remove_files(file_ids):
+        """Remove the data of the parts of deleted uploads.
+
+        It must be called after the deletion of the uploads was committed.
+        """
+        for file_id in file_ids:
+            remove_file_data.delay(str(file_id))
+
+    @classmethod
+    def delete_expired(cls, expires):
+        """Remove the uploads which were not updated for a given time.
+
+        :param expires: A :class:`datetime.timedelta`.
+        :returns: The ids of the file instances of the removed parts.
+        """
+        file_ids = []
+        for upload in cls.query.filter(
+                cls.updated < datetime.utcnow() - expires).all():
+            file_ids.extend(upload.delete())
+        return file_ids
+
+
+class DepositJob(db.Model, Timestamp):
+    """Deposit action running in the background."""
+
+    __tablename__ = 'deposit_job'
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    """Job identifier."""
+
+    record_id = db.Column(
+        UUIDType, db.ForeignKey(RecordMetadata.id), nullable=False)
+    """Deposit the action runs on."""
+
+    action = db.Column(db.String(20), nullable=False)
+    """Name of the deposit action."""
+
+    status = db.Column(db.String(20), nullable=False, default=PENDING)
+    """Job status."""
+
+    message = db.Column(db.Text, nullable=True)
+    """Error message of a failed job."""
+
+    record_class = db.Column(db.String(255), nullable=False)
+    """Import path of the deposit API class running the action."""
+
+    @classmethod
+    def create(cls, record, action):
+        """Create a pending job running an action on the given deposit."""
+        record_class = '{0.__module__}:{0.__name__}'.format(record.__class__)
+        with db.session.begin_nested():
+            job = cls(record_id=record.id, action=action,
+                      record_class=record_class, status=cls.PENDING)
+            db.session.add(job)
+        return job
+
+    @classmethod
+    def get(cls, record, job_id):
+        """Get a job of the given deposit."""
+        return cls.query.filter_by(id=job_id, record_id=record.id).first()
@@ -25,20 +25,54 @@
 """Permissions for deposit."""
 
 import pkg_resources
+from flask import current_app, has_request_context, request
+from flask_login import current_user
 from flask_principal import ActionNeed
 
 action_admin_access = ActionNeed('deposit-admin-access')
 
 
-def admin_permission_factory():
-    """Factory for creating a permission for an admin.
+def load_permission_class():
+    """Load the permission class used for the admin permission.
 
-    :returns: Permission instance.
+    :returns: Invenio-Access ``DynamicPermission`` if installed, otherwise
+        Flask-Principal ``Permission``.
     """
     try:
         pkg_resources.get_distribution('invenio-access')
         from invenio_access.permissions import DynamicPermission as Permission
     except pkg_resources.DistributionNotFound:
         from flask_principal import Permission
+    return Permission
+
+
+def admin_permission_factory():
+    """Factory for creating a permission for an admin.
+
+    The permission class is resolved once by the extension during the
+    application initialization.
+
+    :returns: Permission instance.
+    """
+    for name in ('invenio-deposit', 'invenio-deposit-rest'):
+        state = current_app.extensions.get(name)
+        if state is not None:
+            return state.permission_class(action_admin_access)
+    return load_permission_class()(action_admin_access)
+
+
+def can_admin():
+    """Check the admin permission of the current user.
+
+    The decision is cached for the duration of the request.
+    """
+    if not has_request_context():
+        return admin_permission_factory().can()
 
-    return Permission(action_admin_access)
+    cache = getattr(request, '_deposit_admin_access', None)
+    if cache is None:
+        cache = request._deposit_admin_access = {}
+    user_id = getattr(current_user, 'id', None)
+    if user_id not in cache:
+        cache[user_id] = admin_permission_factory().can()
+    return cache[user_id]
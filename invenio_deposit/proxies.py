@@ -32,3 +32,9 @@ current_deposit = LocalProxy(
     lambda: current_app.extensions['invenio-deposit']
 )
 """Helper proxy to access state object."""
+
+current_schema_map = LocalProxy(
+    lambda: (current_app.extensions.get('invenio-deposit') or
+             current_app.extensions['invenio-deposit-rest']).schema_map
+)
+"""Helper proxy to access the deposit schema map."""
@@ -28,9 +28,19 @@ from __future__ import absolute_import, print_function
 
 from invenio_indexer.tasks import index_record
 
+from .indexer import current_index_queue
+
 
 def index_deposit_after_publish(sender, action=None, pid=None, deposit=None):
-    """Index the record after publishing."""
+    """Index the record after publishing.
+
+    When indexing is deferred, the record is queued with the indexer of the
+    deposit, so that both are sent in the same bulk request.
+    """
     if action == 'publish':
         _, record = deposit.fetch_published()
-        index_record.delay(str(record.id))
+        queue = current_index_queue()
+        if queue is not None:
+            queue.add(deposit.indexer, record)
+        else:
+            index_record.delay(str(record.id))
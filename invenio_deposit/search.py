@@ -30,7 +30,7 @@ from flask_login import current_user
 from invenio_search import RecordsSearch
 from invenio_search.api import DefaultFilter
 
-from .permissions import admin_permission_factory
+from .permissions import can_admin
 
 
 def deposits_filter():
@@ -38,7 +38,7 @@ def deposits_filter():
 
     Allow admin to see all or if we're not in a request.
     """
-    if not has_request_context() or admin_permission_factory().can():
+    if not has_request_context() or can_admin():
         return Q()
     else:
         return Q(
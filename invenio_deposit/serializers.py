@@ -26,7 +26,7 @@
 
 import json
 
-from flask import Response, jsonify, make_response
+from flask import Response, jsonify, make_response, stream_with_context
 
 
 def json_serializer(pid, data, *args):
@@ -40,9 +40,9 @@ def json_serializer(pid, data, *args):
             json.dumps(data.dumps()),
             mimetype='application/json'
         )
+        response.set_etag(str(data.revision_id))
     else:
         response = Response(mimetype='application/json')
-    # response.set_etag(str(data.model.version_id))
     return response
 
 
@@ -61,6 +61,39 @@ def json_file_serializer(obj, status=None):
     return make_response(jsonify(file_serializer(obj)), status)
 
 
+def upload_serializer(upload):
+    """Serialize a multipart upload."""
+    return {
+        "upload_id": str(upload.id),
+        "filename": upload.key,
+        "parts": [file_serializer(obj) for obj in upload.parts],
+    }
+
+
+def json_upload_serializer(upload, status=None):
+    """JSON multipart upload serializer."""
+    return make_response(jsonify(upload_serializer(upload)), status)
+
+
+def job_serializer(job):
+    """Serialize a deposit job."""
+    return {
+        "id": str(job.id),
+        "action": job.action,
+        "status": job.status,
+        "message": job.message,
+        "created": job.created.isoformat(),
+        "updated": job.updated.isoformat(),
+    }
+
+
+def json_job_serializer(job, links=None, status=None):
+    """JSON deposit job serializer."""
+    data = job_serializer(job)
+    data['links'] = links or {}
+    return make_response(jsonify(data), status)
+
+
 def json_files_serializer(objs, status=None):
     """JSON Files Serializer."""
     files = [file_serializer(obj) for obj in objs]
@@ -69,12 +102,44 @@ def json_files_serializer(objs, status=None):
 
 def json_file_response(obj, status=None):
     """JSON Files/File serializer."""
-    from invenio_records_files.api import FilesIterator
+    from invenio_files_rest.models import ObjectVersion
 
-    if isinstance(obj, FilesIterator):
-        return json_files_serializer(objs=obj, status=status)
-    else:
+    from .models import MultipartUpload
+
+    if isinstance(obj, ObjectVersion):
         return json_file_serializer(obj=obj, status=status)
+    elif isinstance(obj, MultipartUpload):
+        return json_upload_serializer(upload=obj, status=status)
+    else:
+        return json_files_serializer(objs=obj, status=status)
+
+
+def ndjson_files_serializer(objs, status=None):
+    """Newline delimited JSON Files serializer.
+
+    The files are serialized while the response is streamed.
+    """
+    def generate():
+        for obj in objs:
+            yield json.dumps(file_serializer(obj)) + '\n'
+
+    return Response(stream_with_context(generate()), status=status,
+                    mimetype='application/x-ndjson')
+
+
+def ndjson_file_response(obj, status=None):
+    """Newline delimited JSON Files/File serializer."""
+    from invenio_files_rest.models import ObjectVersion
+
+    from .models import MultipartUpload
+
+    if isinstance(obj, MultipartUpload):
+        return Response(json.dumps(upload_serializer(obj)) + '\n',
+                        status=status, mimetype='application/x-ndjson')
+    elif isinstance(obj, ObjectVersion):
+        obj = [obj]
+    return ndjson_files_serializer(objs=obj, status=status)
 
 
 json_v1_files_response = json_file_response
+ndjson_v1_files_response = ndjson_file_response
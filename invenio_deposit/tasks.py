@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Celery tasks for deposit actions."""
+
+from __future__ import absolute_import, print_function
+
+from celery import shared_task
+from flask import current_app
+from invenio_db import db
+from werkzeug.utils import import_string
+
+from .indexer import deferred_indexing
+from .models import DepositJob, MultipartUpload
+from .signals import post_action
+
+
+@shared_task(ignore_result=True)
+def publish(job_id):
+    """Publish the deposit of a job and record the outcome on the job.
+
+    The details of a failure are only logged, the job stores a generic
+    message which is shown to the API clients.
+    """
+    job = DepositJob.query.get(job_id)
+    if job is None:
+        current_app.logger.warning('Deposit job {0} not found.'.format(job_id))
+        return
+    job.status = DepositJob.RUNNING
+    db.session.commit()
+
+    with deferred_indexing(
+            bulk=current_app.config['DEPOSIT_DEFERRED_INDEXING']) as queue:
+        try:
+            deposit_class = import_string(job.record_class)
+            deposit = deposit_class.get_record(job.record_id)
+            deposit.publish()
+            job.status = DepositJob.DONE
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            queue.discard(job.record_id)
+            current_app.logger.exception(
+                'Could not publish {0} (job {1}).'.format(
+                    job.record_id, job_id))
+            job = DepositJob.query.get(job_id)
+            job.status = DepositJob.FAILED
+            job.message = 'Publishing failed.'
+            db.session.commit()
+            return
+
+        post_action.send(current_app._get_current_object(),
+                         action='publish', pid=deposit.pid, deposit=deposit)
+
+
+@shared_task(ignore_result=True)
+def delete_expired_uploads():
+    """Remove the multipart uploads which were not completed in time."""
+    file_ids = MultipartUpload.delete_expired(
+        current_app.config['DEPOSIT_MULTIPART_UPLOAD_EXPIRES'])
+    db.session.commit()
+    MultipartUpload.remove_files(file_ids)
+    current_app.logger.info(
+        'Removed expired multipart uploads with {0} parts.'.format(
+            len(file_ids)))
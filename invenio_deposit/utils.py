@@ -26,9 +26,21 @@
 
 from __future__ import absolute_import, print_function
 
-from flask import request
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from copy import copy, deepcopy
+
+from flask import current_app, request
+from flask_login import current_user
 from invenio_oauth2server import require_api_auth, require_oauth_scopes
+from jsonpatch import JsonPatchConflict, JsonPatchException, \
+    JsonPatchTestFailed
+from jsonpointer import JsonPointerException
 
+from .permissions import can_admin
 from .scopes import write_scope
 
 
@@ -51,7 +63,294 @@ def can_elasticsearch(record):
     return search.count() == 1
 
 
+def can_owner(record):
+    """Check that the current user owns the given deposit.
+
+    The decision is taken from ``_deposit.owners`` of the already loaded
+    deposit. Records without owners are accessible to administrators and
+    checked in Elasticsearch if ``DEPOSIT_PERMISSION_ELASTICSEARCH_FALLBACK``
+    is enabled.
+    """
+    owners = record.get('_deposit', {}).get('owners')
+    if owners is None:
+        if current_app.config['DEPOSIT_PERMISSION_ELASTICSEARCH_FALLBACK']:
+            return can_elasticsearch(record)
+        return can_admin()
+    return getattr(current_user, 'id', 0) in owners or can_admin()
+
+
+def check_owner(record, *args, **kwargs):
+    """Check that the current user owns the deposit."""
+    def can(self):
+        return can_owner(record)
+
+    return type('CheckOwner', (), {'can': can})()
+
+
 check_oauth2_scope_write = check_oauth2_scope(lambda x: True, write_scope.id)
 
+check_oauth2_scope_write_owner = check_oauth2_scope(
+    can_owner, write_scope.id)
+
 check_oauth2_scope_write_elasticsearch = check_oauth2_scope(
     can_elasticsearch, write_scope.id)
+
+
+class ChainedStream(object):
+    """Read-only stream concatenating several streams one after another."""
+
+    def __init__(self, streams):
+        """Initialize from an iterable of streams."""
+        self._streams = iter(streams)
+        self._current = None
+
+    def read(self, size=-1):
+        """Read up to ``size`` bytes (everything if negative)."""
+        chunks = []
+        while size < 0 or size > 0:
+            if self._current is None:
+                self._current = next(self._streams, None)
+                if self._current is None:
+                    break
+            chunk = self._current.read(size)
+            if not chunk:
+                self._current.close()
+                self._current = None
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        """Close the remaining streams."""
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        for stream in self._streams:
+            stream.close()
+
+
+ARCHIVE_MIMETYPES = (
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-tar',
+    'application/zip',
+)
+"""Archive types expanded by the batch upload of deposit files."""
+
+ARCHIVE_ERRORS = (
+    EOFError,
+    tarfile.TarError,
+    zipfile.BadZipfile,
+    zlib.error,
+)
+"""Errors raised while reading a malformed or truncated archive."""
+
+
+def iter_archive(stream, mimetype):
+    """Iterate over ``(name, stream)`` of the regular files in an archive.
+
+    Tar archives (optionally compressed) are read sequentially from the
+    stream, zip archives are first spooled to a temporary file.
+    """
+    if mimetype == 'application/zip':
+        with tempfile.SpooledTemporaryFile(max_size=2 ** 20) as fp:
+            shutil.copyfileobj(stream, fp)
+            fp.seek(0)
+            with zipfile.ZipFile(fp) as archive:
+                for info in archive.infolist():
+                    if not info.filename.endswith('/'):
+                        yield info.filename, archive.open(info)
+    else:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+
+
+class SchemaMap(object):
+    """Bidirectional map between deposit and record schema URLs.
+
+    The map is filled from the registered schemas when the extension is
+    initialized. Schemas registered later are resolved on first use and
+    remembered.
+    """
+
+    def __init__(self, prefix):
+        """Initialize an empty map for the given deposit schema prefix."""
+        self.prefix = prefix
+        self.records = {}
+        """Deposit schema URL to record schema URL."""
+        self.deposits = {}
+        """Record schema URL to deposit schema URL."""
+
+    def load(self, jsonschemas):
+        """Map all registered deposit schemas to their record schemas."""
+        for path in jsonschemas.list_schemas():
+            if path.startswith(self.prefix):
+                self._add(jsonschemas.path_to_url(path),
+                          jsonschemas.path_to_url(path[len(self.prefix):]))
+
+    def _add(self, deposit_url, record_url):
+        """Store a pair of schema URLs."""
+        if deposit_url and record_url:
+            self.records[deposit_url] = record_url
+            self.deposits[record_url] = deposit_url
+
+    def record_schema(self, jsonschemas, url):
+        """Return the record schema URL for a deposit schema URL."""
+        try:
+            return self.records[url]
+        except KeyError:
+            path = jsonschemas.url_to_path(url)
+            if path and path.startswith(self.prefix):
+                record_url = jsonschemas.path_to_url(path[len(self.prefix):])
+                self._add(url, record_url)
+                return record_url
+
+    def deposit_schema(self, jsonschemas, url):
+        """Return the deposit schema URL for a record schema URL."""
+        try:
+            return self.deposits[url]
+        except KeyError:
+            path = jsonschemas.url_to_path(url)
+            if path:
+                deposit_url = jsonschemas.path_to_url(self.prefix + path)
+                self._add(deposit_url, url)
+                return deposit_url
+
+
+class CopyOnWritePatch(object):
+    """Apply a JSON Patch without copying the whole document.
+
+    Only the containers on the paths changed by the operations are copied;
+    all other values are shared with the original document, which is left
+    untouched. Operations changing one of the protected top-level fields
+    are rejected before anything is applied.
+    """
+
+    def __init__(self, operations, protected=()):
+        """Initialize the patch and check the protected fields."""
+        self.operations = list(operations)
+        for operation in self.operations:
+            if 'op' not in operation or 'path' not in operation:
+                raise JsonPatchException(
+                    'Operation {0} is not valid.'.format(operation))
+            paths = [operation['path']]
+            if operation['op'] == 'test':
+                paths = []
+            elif operation['op'] == 'move':
+                paths.append(operation.get('from', ''))
+            for path in paths:
+                parts = self.split(path)
+                if not parts or parts[0] in protected:
+                    raise JsonPatchConflict(
+                        'Path "{0}" is protected.'.format(path))
+
+    @staticmethod
+    def split(pointer):
+        """Split a JSON pointer into unescaped parts."""
+        if pointer and not pointer.startswith('/'):
+            raise JsonPointerException(
+                'Location must start with /: {0}'.format(pointer))
+        return [part.replace('~1', '/').replace('~0', '~')
+                for part in pointer.split('/')[1:]]
+
+    @staticmethod
+    def index(container, part, insert=False):
+        """Return the list index designated by a pointer part."""
+        if part == '-' and insert:
+            return len(container)
+        if not part.isdigit() or (part != '0' and part.startswith('0')):
+            raise JsonPointerException('Invalid array index: {0}'.format(
+                part))
+        index = int(part)
+        if index > len(container) or (index == len(container) and
+                                      not insert):
+            raise JsonPatchConflict('Index out of range: {0}'.format(part))
+        return index
+
+    def get(self, document, pointer):
+        """Return the value at a pointer."""
+        value = document
+        for part in self.split(pointer):
+            try:
+                if isinstance(value, list):
+                    value = value[self.index(value, part)]
+                else:
+                    value = value[part]
+            except (KeyError, TypeError, JsonPatchConflict):
+                raise JsonPointerException(
+                    'Member "{0}" not found in {1}'.format(part, pointer))
+        return value
+
+    def parent(self, document, pointer, owned):
+        """Return the copied parent container and the last pointer part."""
+        parts = self.split(pointer)
+        container = document
+        for part in parts[:-1]:
+            if isinstance(container, list):
+                key = self.index(container, part)
+            elif isinstance(container, dict) and part in container:
+                key = part
+            else:
+                raise JsonPointerException(
+                    'Member "{0}" not found in {1}'.format(part, pointer))
+            child = container[key]
+            if id(child) not in owned:
+                child = copy(child)
+                owned.add(id(child))
+                container[key] = child
+            container = child
+        if not isinstance(container, (dict, list)):
+            raise JsonPatchConflict('Cannot change {0}'.format(pointer))
+        return container, parts[-1]
+
+    def add(self, document, pointer, value, owned):
+        """Add a value at a pointer."""
+        container, part = self.parent(document, pointer, owned)
+        if isinstance(container, list):
+            container.insert(self.index(container, part, insert=True), value)
+        else:
+            container[part] = value
+
+    def remove(self, document, pointer, owned):
+        """Remove and return the value at a pointer."""
+        container, part = self.parent(document, pointer, owned)
+        try:
+            if isinstance(container, list):
+                return container.pop(self.index(container, part))
+            return container.pop(part)
+        except (KeyError, JsonPatchConflict):
+            raise JsonPointerException(
+                'Member "{0}" not found in {1}'.format(part, pointer))
+
+    def apply(self, document):
+        """Return a patched shallow copy of the document."""
+        document = dict(document)
+        owned = {id(document)}
+        for operation in self.operations:
+            op, path = operation['op'], operation['path']
+            if op == 'add':
+                self.add(document, path, deepcopy(operation['value']), owned)
+            elif op == 'remove':
+                self.remove(document, path, owned)
+            elif op == 'replace':
+                self.remove(document, path, owned)
+                self.add(document, path, deepcopy(operation['value']), owned)
+            elif op == 'move':
+                value = self.remove(document, operation['from'], owned)
+                self.add(document, path, value, owned)
+            elif op == 'copy':
+                self.add(document, path,
+                         deepcopy(self.get(document, operation['from'])),
+                         owned)
+            elif op == 'test':
+                if self.get(document, path) != operation['value']:
+                    raise JsonPatchTestFailed(
+                        'Test failed for {0}.'.format(path))
+            else:
+                raise JsonPatchException(
+                    'Unknown operation {0}.'.format(op))
+        return document
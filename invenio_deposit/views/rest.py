@@ -26,7 +26,9 @@
 
 from __future__ import absolute_import, print_function
 
+import hashlib
 import json
+import uuid
 from copy import deepcopy
 from functools import partial
 
@@ -34,6 +36,7 @@ from flask import Blueprint, abort, current_app, make_response, request, \
     url_for
 from invenio_db import db
 from invenio_files_rest.errors import InvalidOperationError
+from invenio_files_rest.models import ObjectVersion
 from invenio_oauth2server import require_api_auth, require_oauth_scopes
 from invenio_pidstore.errors import PIDInvalidAction
 from invenio_records_rest.utils import obj_or_import_string
@@ -47,11 +50,16 @@ from webargs import fields
 from webargs.flaskparser import use_kwargs
 from werkzeug.utils import secure_filename
 
+from .. import tasks
 from ..api import Deposit
-from ..errors import FileAlreadyExists, WrongFile
+from ..errors import FileAlreadyExists, WrongFile, WrongPartNumber
+from ..indexer import deferred_indexing
+from ..models import DepositJob, MultipartUpload
 from ..scopes import write_scope
 from ..search import DepositSearch
+from ..serializers import json_job_serializer
 from ..signals import post_action
+from ..utils import ARCHIVE_ERRORS, ARCHIVE_MIMETYPES, iter_archive
 
 
 def create_blueprint(endpoints):
@@ -148,6 +156,19 @@ def create_blueprint(endpoints):
             methods=['POST'],
         )
 
+        deposit_job = DepositJobResource.as_view(
+            DepositJobResource.view_name.format(endpoint),
+            serializers=serializers,
+            pid_type=options['pid_type'],
+            ctx=ctx,
+        )
+
+        blueprint.add_url_rule(
+            '{0}/jobs/<uuid:job_id>'.format(options['item_route']),
+            view_func=deposit_job,
+            methods=['GET'],
+        )
+
         deposit_files = DepositFilesResource.as_view(
             DepositFilesResource.view_name.format(endpoint),
             serializers=files_serializers,
@@ -171,11 +192,86 @@ def create_blueprint(endpoints):
         blueprint.add_url_rule(
             file_item_route,
             view_func=deposit_file,
-            methods=['GET', 'PUT', 'DELETE'],
+            methods=['GET', 'POST', 'PUT', 'DELETE'],
         )
     return blueprint
 
 
+def check_if_match(etag):
+    """Abort with 412 if the ``If-Match`` header does not match the ETag."""
+    if request.if_match and (
+            etag is None or not request.if_match.contains(etag)):
+        abort(412)
+
+
+def not_modified(etag):
+    """Return a 304 response if ``If-None-Match`` matches the ETag."""
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+
+def deposit_etag(record):
+    """Return the ETag of a deposit."""
+    return str(record.revision_id)
+
+
+def file_etag(record, key):
+    """Return the ETag of a deposit file or ``None`` if it does not exist."""
+    if key in record.files:
+        return str(record.files[key].obj.version_id)
+
+
+def files_state(record):
+    """Return the stored state of the deposit files listing.
+
+    It is computed from the bucket modification time and the file versions
+    stored in the deposit, without querying the file objects.
+    """
+    files = record.files
+    parts = []
+    if files is not None:
+        parts.append(str(files.bucket.id))
+        parts.append(files.bucket.updated.isoformat())
+    parts.extend('{0}:{1}'.format(data.get('key'), data.get('version_id'))
+                 for data in record.get('_files', []))
+    return '\n'.join(parts)
+
+
+def files_etag(state, media_type):
+    """Return the ETag of a representation of the deposit files listing."""
+    return hashlib.md5('\n'.join([media_type, state]).encode('utf-8')) \
+        .hexdigest()
+
+
+def set_files_etag(response, etag):
+    """Set the files listing ETag varying with the negotiated media type."""
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+
+def make_job_response(pid, job, status=None):
+    """Serialize a deposit job with its links."""
+    location = url_for('.{0}_job'.format(pid.pid_type),
+                       pid_value=pid.pid_value, job_id=job.id, _external=True)
+    response = json_job_serializer(job, links=dict(
+        self=location,
+        deposit=url_for('.{0}_item'.format(pid.pid_type),
+                        pid_value=pid.pid_value, _external=True),
+    ), status=status)
+    response.headers['Location'] = location
+    return response
+
+
+def make_file_response(view, record, key, status=None):
+    """Serialize a deposit file with its ETag."""
+    response = view.make_response(obj=record.files[key].obj, status=status)
+    response.set_etag(file_etag(record, key))
+    return response
+
+
 class DepositActionResource(ContentNegotiatedMethodView):
     """Deposit action resource."""
 
@@ -195,22 +291,77 @@ class DepositActionResource(ContentNegotiatedMethodView):
     @pass_record
     @need_record_permission('update_permission_factory')
     def post(self, pid, record, action):
-        """Handle deposit action."""
-        getattr(record, action)(pid=pid)
-
-        db.session.commit()
-        # Refresh the PID and record metadata
-        db.session.refresh(pid)
-        db.session.refresh(record.model)
-        post_action.send(current_app._get_current_object(), action=action,
-                         pid=pid, deposit=record)
+        """Handle deposit action.
+
+        The session is committed without expiring its objects, so that the
+        response is built from the state written by the action instead of
+        reloading the PID and the deposit from the database. The changed
+        deposit and records are indexed once, after the commit.
+        """
+        check_if_match(deposit_etag(record))
+        if action == 'publish' and \
+                current_app.config['DEPOSIT_ASYNC_PUBLISH']:
+            return self.publish_async(pid, record)
+        with deferred_indexing(
+                bulk=current_app.config['DEPOSIT_DEFERRED_INDEXING']):
+            record = getattr(record, action)(pid=pid)
+
+            session = db.session()
+            expire_on_commit = session.expire_on_commit
+            session.expire_on_commit = False
+            try:
+                db.session.commit()
+            finally:
+                session.expire_on_commit = expire_on_commit
+            post_action.send(current_app._get_current_object(),
+                             action=action, pid=pid, deposit=record)
         response = self.make_response(pid, record,
                                       202 if action == 'publish' else 201)
         endpoint = '.{0}_item'.format(pid.pid_type)
         location = url_for(endpoint, pid_value=pid.pid_value, _external=True)
         response.headers.extend(dict(Location=location))
+        response.set_etag(deposit_etag(record))
         return response
 
+    def publish_async(self, pid, record):
+        """Publish the deposit in a background task.
+
+        The response describes the job, whose status is available at the
+        ``Location`` of the response.
+        """
+        if 'draft' != record['_deposit']['status']:
+            raise PIDInvalidAction()
+        job = DepositJob.create(record, 'publish')
+        db.session.commit()
+        tasks.publish.delay(str(job.id))
+        return make_job_response(pid, job, status=202)
+
+
+class DepositJobResource(ContentNegotiatedMethodView):
+    """Deposit job resource."""
+
+    view_name = '{0}_job'
+
+    def __init__(self, serializers, pid_type, ctx, *args, **kwargs):
+        """Constructor."""
+        super(DepositJobResource, self).__init__(
+            serializers,
+            default_media_type=ctx.get('default_media_type'),
+            *args,
+            **kwargs
+        )
+        for key, value in ctx.items():
+            setattr(self, key, value)
+
+    @pass_record
+    @need_record_permission('read_permission_factory')
+    def get(self, pid, record, job_id):
+        """Get the status of a deposit job."""
+        job = DepositJob.get(record, job_id)
+        if job is None:
+            abort(404)
+        return make_job_response(pid, job)
+
 
 class DepositFilesResource(ContentNegotiatedMethodView):
     """Deposit files resource."""
@@ -230,15 +381,79 @@ class DepositFilesResource(ContentNegotiatedMethodView):
     @pass_record
     @need_record_permission('read_permission_factory')
     def get(self, pid, record):
-        """Get deposit/depositions/:id/files."""
-        return self.make_response(record.files)
+        """Get deposit/depositions/:id/files.
+
+        The ``after`` and ``size`` arguments paginate the files ordered by
+        key; the next page is announced in the ``Link`` header. The page
+        size is limited by ``DEPOSIT_FILES_MAX_PAGE_SIZE``. A matching
+        ``If-None-Match`` header is answered with 304 before the files are
+        listed.
+        """
+        etag = self.listing_etag(record)
+        response = not_modified(etag) or self.list_files(pid, record)
+        return set_files_etag(response, etag)
+
+    def listing_etag(self, record):
+        """Return the ETag of the listing in the negotiated media type."""
+        media_types = sorted(self.serializers, key=lambda media_type: (
+            media_type != self.default_media_type, media_type))
+        media_type = request.accept_mimetypes.best_match(
+            media_types, default=media_types[0])
+        return files_etag(files_state(record), media_type)
+
+    def check_files_if_match(self, record):
+        """Abort with 412 if ``If-Match`` does not match the stored listing.
+
+        The ETag of any representation of the listing matches, as the
+        condition is on the stored files and not on the media type.
+        """
+        if request.if_match:
+            state = files_state(record)
+            if not any(request.if_match.contains(files_etag(state, media))
+                       for media in self.serializers):
+                abort(412)
+
+    def list_files(self, pid, record):
+        """Serialize the (paginated) listing of deposit files."""
+        after = request.args.get('after')
+        size = request.args.get('size', type=int)
+        if after is None and size is None:
+            return self.make_response(record.file_objects())
+        max_size = current_app.config['DEPOSIT_FILES_MAX_PAGE_SIZE']
+        if size is None:
+            size = max_size
+        if size < 1:
+            abort(400)
+        size = min(size, max_size)
+
+        objs = list(record.file_objects(after=after, size=size))
+        response = self.make_response(objs)
+        if len(objs) == size:
+            response.headers['Link'] = '<{0}>; rel="next"'.format(url_for(
+                request.endpoint, pid_value=pid.pid_value,
+                after=objs[-1].key, size=size, _external=True,
+            ))
+        return response
 
     @require_api_auth()
     @require_oauth_scopes(write_scope.id)
     @pass_record
     @need_record_permission('update_permission_factory')
     def post(self, pid, record):
-        """Handle POST deposit files."""
+        """Handle POST deposit files.
+
+        A single ``file`` part adds one file. Several ``files`` parts or a
+        tar/zip archive in the request body add all the files at once.
+        """
+        self.check_files_if_match(record)
+        if request.mimetype in ARCHIVE_MIMETYPES:
+            return self.add_files(
+                record, iter_archive(request.stream, request.mimetype))
+        elif 'files' in request.files:
+            return self.add_files(record, (
+                (uploaded_file.filename, uploaded_file.stream)
+                for uploaded_file in request.files.getlist('files')
+            ))
         # load the file
         uploaded_file = request.files['file']
         # file name
@@ -250,9 +465,41 @@ class DepositFilesResource(ContentNegotiatedMethodView):
             raise FileAlreadyExists()
         # add it to the deposit
         record.files[key] = uploaded_file.stream
-        record.commit()
+        record.commit_files()
         db.session.commit()
-        return self.make_response(obj=record.files[key].obj, status=201)
+        return make_file_response(self, record, key, status=201)
+
+    def add_files(self, record, files):
+        """Add several files in one transaction and one deposit commit.
+
+        :param files: Iterable of ``(name, stream)`` pairs.
+        :returns: The listing of all deposit files.
+        """
+        record_files = record.files
+        storages = []
+        try:
+            try:
+                with db.session.begin_nested():
+                    for name, stream in files:
+                        key = secure_filename(name)
+                        if not key:
+                            raise WrongFile()
+                        if key in record_files:
+                            raise FileAlreadyExists()
+                        record_files[key] = stream
+                        storages.append(
+                            record_files[key].obj.file.storage())
+            except ARCHIVE_ERRORS:
+                raise WrongFile()
+        except Exception:
+            # the rolled back files no longer reference their data
+            for storage in storages:
+                storage.delete()
+            raise
+        record.commit_files()
+        db.session.commit()
+        response = self.make_response(record.file_objects(), status=201)
+        return set_files_etag(response, self.listing_etag(record))
 
     @require_api_auth()
     @require_oauth_scopes(write_scope.id)
@@ -260,6 +507,7 @@ class DepositFilesResource(ContentNegotiatedMethodView):
     @need_record_permission('update_permission_factory')
     def put(self, pid, record):
         """Handle PUT deposit files."""
+        self.check_files_if_match(record)
         try:
             ids = [data['id'] for data in json.loads(
                 request.data.decode('utf-8'))]
@@ -267,9 +515,10 @@ class DepositFilesResource(ContentNegotiatedMethodView):
             raise WrongFile()
 
         record.files.sort_by(*ids)
-        record.commit()
+        record.commit_files()
         db.session.commit()
-        return self.make_response(record.files)
+        response = self.make_response(record.file_objects())
+        return set_files_etag(response, self.listing_etag(record))
 
 
 class DepositFileResource(ContentNegotiatedMethodView):
@@ -302,16 +551,82 @@ class DepositFileResource(ContentNegotiatedMethodView):
         """Get deposit/depositions/:id/files/:key."""
         try:
             obj = record.files[str(key)].get_version(version_id=version_id)
-            return self.make_response(obj=obj or abort(404))
         except KeyError:
             abort(404)
+        if obj is None:
+            abort(404)
+        etag = str(obj.version_id)
+        response = not_modified(etag) or self.make_response(obj=obj)
+        response.set_etag(etag)
+        return response
+
+    def get_upload(self, record, key):
+        """Get the multipart upload given by ``upload_id`` argument."""
+        try:
+            upload_id = uuid.UUID(request.args['upload_id'])
+        except ValueError:
+            abort(404)
+        upload = MultipartUpload.get(record, upload_id)
+        if upload is None or upload.key != key:
+            abort(404)
+        return upload
+
+    @require_api_auth()
+    @require_oauth_scopes(write_scope.id)
+    @pass_record
+    @need_record_permission('update_permission_factory')
+    def post(self, pid, record, key):
+        """Handle multipart upload of a deposit file.
+
+        ``?uploads`` starts a new upload, ``?upload_id=<id>`` concatenates
+        the uploaded parts into the deposit file.
+        """
+        key = str(key)
+        if 'upload_id' in request.args:
+            upload = self.get_upload(record, key)
+            check_if_match(file_etag(record, key))
+            status = 200 if key in record.files else 201
+            record.files[key] = upload.open()
+            file_ids = upload.delete()
+            record.commit_files()
+            db.session.commit()
+            MultipartUpload.remove_files(file_ids)
+            return make_file_response(self, record, key, status=status)
+        elif 'uploads' in request.args:
+            if 'draft' != record['_deposit']['status']:
+                raise PIDInvalidAction()
+            if not key or key != secure_filename(key):
+                raise WrongFile()
+            upload = MultipartUpload.create(record, key)
+            db.session.commit()
+            return self.make_response(obj=upload, status=201)
+        abort(400)
 
     @require_api_auth()
     @require_oauth_scopes(write_scope.id)
     @pass_record
     @need_record_permission('update_permission_factory')
     def put(self, pid, record, key):
-        """Handle PUT deposit files."""
+        """Handle PUT deposit files.
+
+        A request with ``application/octet-stream`` body uploads the content
+        of the file (or of one part given by ``upload_id`` and
+        ``part_number`` arguments), otherwise the body describes the file
+        rename.
+        """
+        if 'upload_id' in request.args:
+            if 'draft' != record['_deposit']['status']:
+                raise PIDInvalidAction()
+            upload = self.get_upload(record, str(key))
+            part_number = request.args.get('part_number', type=int)
+            if part_number is None or part_number < 1:
+                raise WrongPartNumber()
+            obj = upload.set_part(part_number, request.stream)
+            db.session.commit()
+            return self.make_response(obj=obj)
+        check_if_match(file_etag(record, str(key)))
+        if request.mimetype == 'application/octet-stream':
+            return self.upload(record, str(key))
         try:
             data = json.loads(request.data.decode('utf-8'))
             new_key = data['filename']
@@ -321,22 +636,57 @@ class DepositFileResource(ContentNegotiatedMethodView):
         if not new_key_secure or new_key != new_key_secure:
             raise WrongFile()
         try:
-            obj = record.files.rename(str(key), new_key_secure)
+            record.files.rename(str(key), new_key_secure)
         except KeyError:
             abort(404)
-        record.commit()
+        record.commit_files()
         db.session.commit()
-        return self.make_response(obj=obj)
+        return make_file_response(self, record, new_key_secure)
+
+    def upload(self, record, key):
+        """Stream the request body into the file storage.
+
+        The raw request stream is passed to the storage backend, which copies
+        it in chunks and computes the checksum on the fly, so the body is
+        neither parsed as multipart nor spooled to a temporary file. The
+        ``Content-Length`` header is required so the storage can check the
+        size and quota of the bucket before reading the body.
+        """
+        if request.content_length is None:
+            abort(411)
+        if not key or key != secure_filename(key):
+            raise WrongFile()
+        files = record.files
+        status = 200 if key in files else 201
+        # same as ``files[key] = stream`` but with the size known up front
+        with db.session.begin_nested():
+            obj = ObjectVersion.create(
+                files.bucket, key, stream=request.stream,
+                size=request.content_length)
+            files.filesmap[key] = files.file_cls(obj, {}).dumps()
+            files.flush()
+        record.commit_files()
+        db.session.commit()
+        return make_file_response(self, record, key, status=status)
 
     @require_api_auth()
     @require_oauth_scopes(write_scope.id)
     @pass_record
     @need_record_permission('update_permission_factory')
     def delete(self, pid, record, key):
-        """Handle DELETE deposit files."""
+        """Handle DELETE deposit files.
+
+        With ``upload_id`` argument the multipart upload is aborted instead.
+        """
+        if 'upload_id' in request.args:
+            file_ids = self.get_upload(record, str(key)).delete()
+            db.session.commit()
+            MultipartUpload.remove_files(file_ids)
+            return make_response('', 204)
+        check_if_match(file_etag(record, str(key)))
         try:
             del record.files[str(key)]
-            record.commit()
+            record.commit_files()
             db.session.commit()
             return make_response('', 204)
         except KeyError:
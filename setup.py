@@ -66,6 +66,7 @@ install_requires = [
     'Flask-Login>=0.3.2',
     'SQLAlchemy-Continuum>=1.2.1',
     'SQLAlchemy-Utils[encrypted]>=0.31.0',
+    'celery>=3.1.0',
     'dictdiffer>=0.5.0.post1',
     'elasticsearch-dsl>=2.0.0',
     'invenio-db[versioning]>=1.0.0a9',
@@ -79,6 +80,7 @@ install_requires = [
     'invenio-records>=1.0.0a15',
     'invenio-search-ui>=1.0.0a4',
     'invenio-search>=1.0.0a7',
+    'jsonpatch>=1.11',
 ]
 
 packages = find_packages()
@@ -121,6 +123,12 @@ setup(
         'invenio_i18n.translations': [
             'messages = invenio_deposit',
         ],
+        'invenio_db.models': [
+            'invenio_deposit = invenio_deposit.models',
+        ],
+        'invenio_celery.tasks': [
+            'invenio_deposit = invenio_deposit.tasks',
+        ],
         'invenio_pidstore.fetchers': [
             'deposit = invenio_deposit.fetchers:deposit_fetcher',
         ],
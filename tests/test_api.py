@@ -26,15 +26,50 @@
 
 from __future__ import absolute_import, print_function
 
+import json
+from datetime import datetime, timedelta
+
 import pytest
+from invenio_files_rest.models import Bucket, FileInstance, ObjectVersion
 from invenio_pidstore.errors import PIDInvalidAction
 from invenio_records.errors import MissingModelError
-from jsonschema.exceptions import RefResolutionError
+from invenio_records.signals import before_record_insert
+from invenio_records_files.api import Record
+from jsonpatch import JsonPatchException
+from jsonpointer import JsonPointerException
+from jsonschema.exceptions import RefResolutionError, ValidationError
 from six import BytesIO
+from sqlalchemy import event
 from sqlalchemy.orm.exc import NoResultFound
 
-from invenio_deposit.api import Deposit
+from invenio_deposit import receivers, tasks
+from invenio_deposit.api import Deposit, schema_validator
 from invenio_deposit.errors import MergeConflict
+from invenio_deposit.indexer import deferred_indexing, flush_index_queue
+from invenio_deposit.models import DepositJob, MultipartUpload
+from invenio_deposit.serializers import json_files_serializer
+
+
+class RecordingIndexer(object):
+    """Indexer keeping track of the sent records."""
+
+    def __init__(self):
+        """Initialize empty lists of operations."""
+        self.indexed = []
+        self.deleted = []
+        self.bulk = []
+
+    def index(self, record):
+        """Record an index operation."""
+        self.indexed.append(str(record.id))
+
+    def delete(self, record):
+        """Record a delete operation."""
+        self.deleted.append(str(record.id))
+
+    def bulk_index(self, record_id_iterator):
+        """Record a bulk index operation."""
+        self.bulk.append(list(record_id_iterator))
 
 
 def test_schemas(app, db, fake_schemas):
@@ -57,6 +92,124 @@ def test_schemas(app, db, fake_schemas):
         })
 
 
+def test_schema_map(app, db, fake_schemas):
+    """Test the precomputed schema map."""
+    schema_map = app.extensions['invenio-deposit'].schema_map
+    schema_map.load(app.extensions['invenio-jsonschemas'])
+    deposit_url = 'http://localhost/schemas/deposits/deposit-v1.0.0.json'
+    record_url = 'http://localhost/schemas/deposit-v1.0.0.json'
+    assert schema_map.records[deposit_url] == record_url
+    assert schema_map.deposits[record_url] == deposit_url
+
+    deposit = Deposit.create({})
+    assert deposit.record_schema == record_url
+    assert deposit.build_deposit_schema({'$schema': record_url}) == \
+        deposit_url
+
+    # unknown schemas are resolved once and not stored when missing
+    assert deposit.build_deposit_schema({
+        '$schema': 'http://localhost/schemas/invalid.json',
+    }) is None
+    assert 'http://localhost/schemas/invalid.json' not in schema_map.deposits
+
+
+def test_schema_validator(app, db, fake_schemas):
+    """Test caching of the schema validators."""
+    url = 'http://localhost/schemas/deposits/test-v1.0.0.json'
+    assert schema_validator(url) is schema_validator(url)
+    Deposit.create({'$schema': url})
+
+
+def test_skip_draft_validation(app, db, fake_schemas, location):
+    """Test that drafts are validated only on publish if configured."""
+    app.config['DEPOSIT_VALIDATE_DRAFTS'] = False
+    deposit = Deposit.create({
+        '$schema': 'http://localhost/schemas/deposits/invalid.json',
+    })
+    deposit['title'] = 'Draft'
+    deposit.commit()
+    with pytest.raises(RefResolutionError):
+        deposit.publish()
+
+
+def test_partial_validation(app, db, fake_schemas, tmpdir):
+    """Test validation of the patched fields only."""
+    schemas = tmpdir.mkdir('partial')
+    schemas.mkdir('deposits').join('partial-v1.0.0.json').write(json.dumps({
+        'type': 'object',
+        'properties': {
+            'title': {'type': 'string'},
+            'count': {'type': 'integer'},
+            'meta': {
+                'type': 'object',
+                'properties': {'size': {'type': 'integer'}},
+                'required': ['size'],
+            },
+        },
+    }))
+    app.extensions['invenio-jsonschemas'].register_schemas_dir(
+        schemas.strpath)
+    app.config['DEPOSIT_PARTIAL_VALIDATION'] = True
+
+    deposit = Deposit.create({
+        '$schema': 'http://localhost/schemas/deposits/partial-v1.0.0.json',
+        'meta': {'size': 1},
+    })
+    deposit['count'] = 'invalid'
+    deposit = deposit.patch([
+        {'op': 'replace', 'path': '/title', 'value': 'Title'},
+        {'op': 'replace', 'path': '/meta/size', 'value': 2},
+    ])
+    deposit.commit()
+
+    with pytest.raises(ValidationError):
+        deposit.patch([{'op': 'replace', 'path': '/meta/size',
+                        'value': 'invalid'}]).commit()
+    with pytest.raises(ValidationError):
+        deposit.patch([{'op': 'remove', 'path': '/meta/size'}]).commit()
+    with pytest.raises(ValidationError):
+        deposit.commit()
+
+    app.config['DEPOSIT_PARTIAL_VALIDATION'] = False
+    with pytest.raises(ValidationError):
+        deposit.patch([{'op': 'replace', 'path': '/title',
+                        'value': 'Other'}]).commit()
+
+
+def test_patch_copy_on_write(app, db, fake_schemas):
+    """Test patching of drafts without copying unchanged values."""
+    deposit = Deposit.create({
+        'title': 'Title',
+        'big': {'values': list(range(10))},
+        'meta': {'authors': [{'name': 'A'}, {'name': 'B'}]},
+    })
+    patched = deposit.patch([
+        {'op': 'replace', 'path': '/meta/authors/1/name', 'value': 'C'},
+        {'op': 'add', 'path': '/meta/authors/-', 'value': {'name': 'D'}},
+        {'op': 'copy', 'from': '/title', 'path': '/subtitle'},
+        {'op': 'move', 'from': '/meta/authors/0', 'path': '/first'},
+        {'op': 'test', 'path': '/_deposit/status', 'value': 'draft'},
+    ])
+    assert patched['big'] is deposit['big']
+    assert patched['_deposit'] is deposit['_deposit']
+    assert [{'name': 'C'}, {'name': 'D'}] == patched['meta']['authors']
+    assert {'name': 'A'} == patched['first']
+    assert 'Title' == patched['subtitle']
+    assert [{'name': 'A'}, {'name': 'B'}] == deposit['meta']['authors']
+
+    for patch in (
+        [{'op': 'replace', 'path': '/_deposit/status', 'value': 'x'}],
+        [{'op': 'move', 'from': '/_deposit/id', 'path': '/id'}],
+        [{'op': 'replace', 'path': '', 'value': {}}],
+        [{'op': 'remove', 'path': '/missing'}],
+        [{'op': 'add', 'path': '/meta/authors/5', 'value': 'x'}],
+        [{'op': 'test', 'path': '/title', 'value': 'Other'}],
+    ):
+        with pytest.raises((JsonPatchException, JsonPointerException)):
+            deposit.patch(patch)
+    assert 'draft' == deposit['_deposit']['status']
+
+
 def test_simple_flow(app, db, fake_schemas, location):
     """Test simple flow of deposit states through its lifetime."""
     deposit = Deposit.create({})
@@ -222,6 +375,33 @@ def test_publish_revision_changed_mergeable(app, db, location, fake_schemas):
     assert deposit['$schema'] == 'http://localhost/schemas/deposit-v1.0.0.json'
 
 
+def test_edit_after_published_record_changed(app, db, location,
+                                             fake_schemas):
+    """Test that editing uses the latest content of the published record."""
+    deposit = Deposit.create({'title': 'title-1'})
+    deposit.publish()
+    db.session.commit()
+    _, record = deposit.fetch_published()
+
+    # update the published record with another instance
+    external = Record.get_record(record.id)
+    external['poster'] = 'myposter'
+    external.commit()
+    db.session.commit()
+
+    deposit = deposit.edit()
+    db.session.commit()
+    assert 'myposter' == deposit['poster']
+    assert external.revision_id == deposit['_deposit']['pid']['revision_id']
+
+    deposit['title'] = 'title-2'
+    deposit.publish()
+    db.session.commit()
+    _, record = deposit.fetch_published()
+    assert 'title-2' == record['title']
+    assert 'myposter' == record['poster']
+
+
 def test_publish_revision_changed_not_mergeable(app, db, location,
                                                 fake_schemas):
     """Try to Publish and someone change the deposit in the while."""
@@ -253,3 +433,351 @@ def test_publish_revision_changed_not_mergeable(app, db, location,
     deposit.commit()
     with pytest.raises(MergeConflict):
         deposit.publish()
+
+
+def test_deferred_indexing(app, db, fake_schemas, location, monkeypatch):
+    """Test that deposits are indexed once at the end of the block."""
+    indexer = RecordingIndexer()
+    monkeypatch.setattr(Deposit, 'indexer', indexer)
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+
+    with deferred_indexing() as queue:
+        deposit = Deposit.create({})
+        deposit['title'] = 'Revision 1'
+        deposit.commit()
+        deposit['title'] = 'Revision 2'
+        deposit.commit()
+        removed = Deposit.create({})
+        removed.delete()
+
+        assert [] == indexer.indexed
+        assert 1 == len(queue)
+        assert deposit.id in queue
+        assert removed.id not in queue
+
+    assert [[str(deposit.id)]] == indexer.bulk
+    assert {str(deposit.id): deposit.revision_id} == queue.revisions
+    assert [str(removed.id)] == indexer.deleted
+    assert 4 == queue.requested
+    assert 1 == queue.sent
+    assert 3 == queue.saved
+
+
+def test_flush_index_queue(app, db, fake_schemas, location, monkeypatch):
+    """Test that the queue of a failed request is discarded."""
+    indexer = RecordingIndexer()
+    monkeypatch.setattr(Deposit, 'indexer', indexer)
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    app.config['DEPOSIT_DEFERRED_INDEXING'] = True
+
+    with app.test_request_context():
+        deposit = Deposit.create({})
+        flush_index_queue(exception=RuntimeError())
+    assert [] == indexer.bulk
+
+    with app.test_request_context():
+        deposit.commit()
+        flush_index_queue()
+    assert [[str(deposit.id)]] == indexer.bulk
+
+
+def test_deferred_indexing_publish(app, db, fake_schemas, location,
+                                   monkeypatch):
+    """Test that publishing indexes deposit and record only once."""
+    indexer = RecordingIndexer()
+    monkeypatch.setattr(Deposit, 'indexer', indexer)
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+
+    deposit = Deposit.create({})
+    deposit.publish()
+    _, record = deposit.fetch_published()
+    monkeypatch.setattr('invenio_deposit.api.Resolver', None)
+
+    with deferred_indexing() as queue:
+        deposit.commit()
+        receivers.index_deposit_after_publish(
+            app, action='publish', deposit=deposit)
+        receivers.index_deposit_after_publish(
+            app, action='publish', deposit=deposit)
+
+    assert [[str(deposit.id), str(record.id)]] == indexer.bulk
+    assert 1 == queue.saved
+
+
+def test_publish_many(app, db, fake_schemas, location, monkeypatch):
+    """Test publishing several deposits at once."""
+    indexer = RecordingIndexer()
+    monkeypatch.setattr(Deposit, 'indexer', indexer)
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+
+    drafts = [Deposit.create({'title': str(i)}) for i in range(3)]
+    published = Deposit.create({})
+    published.publish()
+    indexer.indexed = []
+
+    done, failed = Deposit.publish_many(drafts + [published])
+    assert drafts == done
+    assert [published] == [deposit for deposit, _ in failed]
+    assert isinstance(failed[0][1], PIDInvalidAction)
+
+    ids = []
+    for deposit in drafts:
+        assert 'published' == deposit['_deposit']['status']
+        _, record = deposit.fetch_published()
+        assert deposit['title'] == record['title']
+        ids.extend([str(deposit.id), str(record.id)])
+    assert [] == indexer.indexed
+    assert [ids] == indexer.bulk
+
+
+def test_publish_many_batch(app, db, fake_schemas, location, monkeypatch):
+    """Test that new deposits are published with one records insert."""
+    monkeypatch.setattr(Deposit, 'indexer', RecordingIndexer())
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    drafts = [Deposit.create({'title': str(i)}) for i in range(5)]
+    drafts[0].files['hello.txt'] = BytesIO(b'Hello world!')
+    db.session.commit()
+    statements = []
+
+    def on_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        done, failed = Deposit.publish_many(drafts)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+    assert drafts == done
+    assert [] == failed
+    assert 1 == len([statement for statement in statements
+                     if statement.startswith('INSERT INTO records_metadata ')])
+
+    _, record = drafts[0].fetch_published()
+    assert ['hello.txt'] == [f['key'] for f in record['_files']]
+    assert record.files.bucket.id != drafts[0].files.bucket.id
+    assert drafts[0].files.bucket.locked
+
+
+def test_publish_many_fallback(app, db, fake_schemas, location,
+                               monkeypatch):
+    """Test that a failing batch is published one deposit at a time."""
+    monkeypatch.setattr(Deposit, 'indexer', RecordingIndexer())
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    drafts = [Deposit.create({'title': title})
+              for title in ('first', 'broken', 'last')]
+
+    def reject(sender, *args, **kwargs):
+        record = kwargs.get('record', sender)
+        if record.get('title') == 'broken':
+            raise ValueError('broken')
+
+    before_record_insert.connect(reject)
+    try:
+        done, failed = Deposit.publish_many(drafts)
+    finally:
+        before_record_insert.disconnect(reject)
+    assert [drafts[0], drafts[2]] == done
+    assert [(drafts[1], 'broken')] == [
+        (deposit, str(exc)) for deposit, exc in failed]
+    assert 'draft' == drafts[1]['_deposit']['status']
+    assert 'pid' not in drafts[1]['_deposit']
+    for deposit in done:
+        _, record = deposit.fetch_published()
+        assert deposit['title'] == record['title']
+
+
+class CustomDeposit(Deposit):
+    """Deposit API class keeping track of the publish calls."""
+
+    published_ids = []
+
+    def publish(self, *args, **kwargs):
+        """Record the publish call."""
+        self.published_ids.append(self.id)
+        return super(CustomDeposit, self).publish(*args, **kwargs)
+
+
+def test_publish_many_custom(app, db, fake_schemas, location, monkeypatch):
+    """Test that customized publishing is not bypassed by the batch."""
+    monkeypatch.setattr(Deposit, 'indexer', RecordingIndexer())
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    monkeypatch.setattr(CustomDeposit, 'published_ids', [])
+    drafts = [CustomDeposit.create({'title': str(i)}) for i in range(2)]
+    assert not drafts[0]._can_publish_in_batch()
+    assert Deposit.create({})._can_publish_in_batch()
+
+    done, failed = CustomDeposit.publish_many(drafts)
+    assert drafts == done
+    assert [] == failed
+    assert [deposit.id for deposit in drafts] == CustomDeposit.published_ids
+
+
+def test_publish_job_record_class(app, db, fake_schemas, location,
+                                  monkeypatch):
+    """Test that a publish job uses the API class of the deposit."""
+    monkeypatch.setattr(Deposit, 'indexer', RecordingIndexer())
+    deposit = CustomDeposit.create({})
+    job = DepositJob.create(deposit, 'publish')
+    db.session.commit()
+    assert '{0}:CustomDeposit'.format(__name__) == job.record_class
+
+    monkeypatch.setattr(CustomDeposit, 'published_ids', [])
+    tasks.publish(str(job.id))
+    assert [deposit.id] == CustomDeposit.published_ids
+    assert DepositJob.DONE == DepositJob.query.get(job.id).status
+
+
+def test_delete_expired_uploads(app, db, fake_schemas, location):
+    """Test removing the multipart uploads which were not completed."""
+    deposit = Deposit.create({})
+    expired = MultipartUpload.create(deposit, 'expired.txt')
+    expired.set_part(1, BytesIO(b'part'))
+    active = MultipartUpload.create(deposit, 'active.txt')
+    db.session.commit()
+    expired.updated = datetime.utcnow() - timedelta(days=8)
+    db.session.commit()
+    bucket_id = expired.bucket_id
+    file_id = expired.parts[0].file_id
+
+    tasks.delete_expired_uploads()
+    assert [active.id] == [upload.id for upload in MultipartUpload.query]
+    assert Bucket.query.get(bucket_id) is None
+    assert 0 == ObjectVersion.query.filter_by(bucket_id=bucket_id).count()
+    assert FileInstance.query.get(file_id) is None
+
+
+def test_commit_files(app, db, fake_schemas, location):
+    """Test storing only the files of a deposit."""
+    deposit = Deposit.create({})
+    deposit.commit()
+    db.session.commit()
+    revision_id = deposit.revision_id
+
+    deposit.files['hello.txt'] = BytesIO(b'Hello world!')
+    deposit['title'] = 'Not stored'
+    deposit.commit_files()
+    db.session.commit()
+    assert revision_id + 1 == deposit.revision_id
+
+    db.session.expunge(deposit.model)
+    deposit = Deposit.get_record(deposit.id)
+    assert ['hello.txt'] == [f['key'] for f in deposit['_files']]
+    assert 'title' not in deposit
+
+    with pytest.raises(MissingModelError):
+        Deposit({}).commit_files()
+
+
+def test_file_objects_queries(app, db, fake_schemas, location):
+    """Test that listing deposit files uses a constant number of queries."""
+    deposit = Deposit.create({})
+    queries = []
+
+    def count_queries(*args, **kwargs):
+        queries.append(args)
+
+    def serialize():
+        del queries[:]
+        event.listen(db.engine, 'before_cursor_execute', count_queries)
+        try:
+            json_files_serializer(deposit.file_objects())
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_queries)
+        return len(queries)
+
+    deposit.files['file-0.txt'] = BytesIO(b'file-0')
+    db.session.commit()
+    single = serialize()
+
+    for i in range(1, 10):
+        deposit.files['file-{0}.txt'.format(i)] = BytesIO(b'file')
+    deposit.files.sort_by(*reversed(
+        ['file-{0}.txt'.format(i) for i in range(10)]))
+    db.session.commit()
+    assert single == serialize()
+    assert ['file-{0}.txt'.format(i) for i in reversed(range(10))] == \
+        [obj.key for obj in deposit.file_objects()]
+
+
+def test_merge_with_published_fields(app, db, location, fake_schemas):
+    """Test merging of fields changed on different sides."""
+    deposit = Deposit.create({
+        'title': 'title-1', 'keywords': ['a'], 'removed': 'value',
+    })
+    deposit.publish()
+    deposit = deposit.edit()
+    db.session.commit()
+
+    _, record = deposit.fetch_published()
+    record['title'] = 'title-2'
+    record['note'] = 'external'
+    record.commit()
+    db.session.commit()
+
+    deposit['keywords'] = ['a', 'b']
+    del deposit['removed']
+    deposit.commit()
+
+    merged = deposit.merge_with_published()
+    assert 'title-2' == merged['title']
+    assert 'external' == merged['note']
+    assert ['a', 'b'] == merged['keywords']
+    assert 'removed' not in merged
+    assert deposit['_deposit'] == merged['_deposit']
+    assert deposit['$schema'] == merged['$schema']
+    merged['keywords'].append('c')
+    assert ['a', 'b'] == deposit['keywords']
+
+
+def test_merge_with_published_disjoint(app, db, location, fake_schemas,
+                                       monkeypatch):
+    """Test that disjoint nested changes are merged without dictdiffer."""
+    deposit = Deposit.create({'metadata': {
+        'title': 'title-1', 'authors': [{'name': 'A'}],
+    }})
+    deposit.publish()
+    deposit = deposit.edit()
+    db.session.commit()
+
+    _, record = deposit.fetch_published()
+    record['metadata']['title'] = 'title-2'
+    record.commit()
+    db.session.commit()
+
+    deposit['metadata']['authors'] = [{'name': 'A'}, {'name': 'B'}]
+    deposit.commit()
+
+    def merger(*args):
+        raise AssertionError('Merger should not be used.')
+
+    monkeypatch.setattr('invenio_deposit.api.Merger', merger)
+    merged = deposit.merge_with_published()
+    assert {
+        'title': 'title-2', 'authors': [{'name': 'A'}, {'name': 'B'}],
+    } == merged['metadata']
+
+
+def test_pid_cache(app, db, location, fake_schemas, monkeypatch):
+    """Test that PIDs are resolved only once per deposit instance."""
+    deposit = Deposit.create({})
+    pid = deposit.pid
+    assert pid is deposit.pid
+
+    deposit.publish()
+    monkeypatch.setattr('invenio_deposit.api.Resolver', None)
+
+    deposit = deposit.edit()
+    deposit['title'] = 'Revision 1'
+    deposit.commit()
+    deposit.publish()
+
+    _, published = deposit.fetch_published()
+    assert 'Revision 1' == published['title']
+    assert 1 == published.revision_id
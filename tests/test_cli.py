@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Test deposit CLI."""
+
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import uuid
+from io import StringIO
+
+import click
+import pytest
+from click.testing import CliRunner
+from flask_cli import ScriptInfo
+
+from invenio_deposit.api import Deposit
+from invenio_deposit.cli import create, discard, edit, iter_json, \
+    make_deposit_mapping, publish, schema
+
+
+def test_iter_json():
+    """Test streaming of JSON arrays and JSON lines."""
+    data = [{'title': 'a' * 10}, {'title': '[b]', 'n': [1, 2]}, {}]
+    assert data == list(iter_json(StringIO(u' ' + json.dumps(data)),
+                                  chunk_size=4))
+    lines = u'\n'.join(json.dumps(item) for item in data) + u'\n\n'
+    assert data == list(iter_json(StringIO(lines)))
+    assert [] == list(iter_json(StringIO(u'  ')))
+
+    # a malformed object is reported without reading the rest of the input
+    source = StringIO(u'[{"a": 1}, {"b": ]' + u' ' * 10000 + u']')
+    objects = iter_json(source, chunk_size=16)
+    assert {'a': 1} == next(objects)
+    with pytest.raises(click.BadParameter):
+        next(objects)
+    assert source.tell() < 100
+    for invalid in (u'[1,,2]', u'[1, 2', u'[1} 2]', u'[1 2]'):
+        with pytest.raises(click.BadParameter):
+            list(iter_json(StringIO(invalid)))
+
+
+def test_create(app, db, fake_schemas, location, monkeypatch):
+    """Test creation of deposits from the command line."""
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    monkeypatch.setattr(Deposit.indexer, 'bulk_index', lambda ids: None)
+    runner = CliRunner()
+    obj = ScriptInfo(create_app=lambda info: app)
+    source = '\n'.join(json.dumps({'title': str(i)}) for i in range(5))
+
+    result = runner.invoke(create, ['-b', '2'], input=source, obj=obj)
+    assert 0 == result.exit_code
+    assert 'Created 5 deposits' in result.output
+
+    id_ = uuid.uuid4()
+    result = runner.invoke(create, ['-u', str(id_)], input='{}', obj=obj)
+    assert 0 == result.exit_code
+    assert str(id_) == str(Deposit.get_record(id_).id)
+
+    result = runner.invoke(
+        create, ['-b', '2'], obj=obj,
+        input='{"$schema": "http://localhost/schemas/invalid.json"}')
+    assert 0 != result.exit_code
+
+    result = runner.invoke(
+        create, ['--force'], obj=obj,
+        input='{"$schema": "http://localhost/schemas/invalid.json"}\n{}')
+    assert 0 == result.exit_code
+    assert 'Skipped 1 deposits' in result.output
+
+
+def test_actions(app, db, fake_schemas, location, monkeypatch):
+    """Test publishing, editing and discarding from the command line."""
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    monkeypatch.setattr(Deposit.indexer, 'bulk_index', lambda ids: None)
+    runner = CliRunner()
+    obj = ScriptInfo(create_app=lambda info: app)
+
+    deposits = [Deposit.create({'title': str(i)}) for i in range(3)]
+    db.session.commit()
+    args = []
+    for deposit in deposits:
+        args.extend(['-i', deposit['_deposit']['id']])
+
+    result = runner.invoke(publish, args + ['-c', '2'], obj=obj)
+    assert 0 == result.exit_code
+    assert 'Publish: 3 succeeded, 0 failed.' in result.output
+    for deposit in deposits:
+        deposit = Deposit.get_record(deposit.id)
+        assert 'published' == deposit['_deposit']['status']
+
+    result = runner.invoke(publish, args, obj=obj)
+    assert 1 == result.exit_code
+    assert 'Publish: 0 succeeded, 3 failed.' in result.output
+
+    result = runner.invoke(edit, args[:2], obj=obj)
+    assert 0 == result.exit_code
+    result = runner.invoke(discard, args[:2], obj=obj)
+    assert 0 == result.exit_code
+    assert 'Discard: 1 succeeded, 0 failed.' in result.output
+
+    result = runner.invoke(publish, [], obj=obj)
+    assert 0 != result.exit_code
+
+
+def test_schema(app, fake_schemas, tmpdir):
+    """Test generation of deposit schemas."""
+    runner = CliRunner()
+    obj = ScriptInfo(create_app=lambda info: app)
+
+    result = runner.invoke(
+        schema, ['-o', tmpdir.strpath, 'test-v1.0.0.json'], obj=obj)
+    assert 0 == result.exit_code
+    with open(os.path.join(tmpdir.strpath, 'jsonschemas', 'deposits',
+                           'test-v1.0.0.json')) as fp:
+        data = json.load(fp)
+    assert 'Empty' == data['title']
+    assert '_deposit' in data['properties']
+    assert ['_deposit'] == data['required']
+    assert '../records-files/records-files-v1.0.0.json' == \
+        data['properties']['_files']['items']['$ref']
+
+    result = runner.invoke(
+        schema, ['-o', tmpdir.strpath, 'unknown.json'], obj=obj)
+    assert 0 != result.exit_code
+
+
+def test_make_deposit_mapping():
+    """Test injection of deposit fields in a mapping."""
+    template = {'mappings': {'deposit-v1.0.0': {'properties': {
+        '_deposit': {'type': 'object'}, 'title': {'type': 'integer'},
+    }}}}
+    mapping = {'settings': {}, 'mappings': {'test-v1.0.0': {'properties': {
+        'title': {'type': 'string'},
+    }}}}
+    assert {'settings': {}, 'mappings': {'test-v1.0.0': {'properties': {
+        '_deposit': {'type': 'object'}, 'title': {'type': 'string'},
+    }}}} == make_deposit_mapping(mapping, template, 'test-v1.0.0')
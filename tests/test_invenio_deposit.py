@@ -30,10 +30,14 @@ from __future__ import absolute_import, print_function
 import pytest
 from flask import Flask
 from flask_cli import FlaskCLI
+from flask_security import login_user
 from invenio_records_rest.utils import PIDConverter
 
 from invenio_deposit import InvenioDeposit
+from invenio_deposit.permissions import action_admin_access, \
+    admin_permission_factory, can_admin
 from invenio_deposit.proxies import current_deposit
+from invenio_deposit.utils import can_owner
 
 
 def test_version():
@@ -63,7 +67,37 @@ def test_init():
     assert 'invenio-deposit' not in app.extensions
     ext.init_app(app)
     assert 'invenio-deposit' in app.extensions
+    assert ext.permission_class
 
     # check that current_deposit resolves correctly
     with app.app_context():
         current_deposit.init_app
+
+
+def test_can_owner(app, db, users, monkeypatch):
+    """Test ownership check without Elasticsearch."""
+    owned = {'_deposit': {'owners': [users[0].id]}}
+    with app.test_request_context():
+        assert not can_owner(owned)
+        login_user(users[0])
+        assert can_owner(owned)
+        assert not can_owner({'_deposit': {'owners': [users[1].id]}})
+        assert not can_owner({})
+
+    # administrators can access any deposit
+    monkeypatch.setattr('invenio_deposit.utils.can_admin', lambda: True)
+    with app.test_request_context():
+        login_user(users[1])
+        assert can_owner(owned)
+        assert can_owner({})
+
+
+def test_can_admin(app, db, users):
+    """Test admin permission uses the class resolved by the extension."""
+    assert isinstance(admin_permission_factory(),
+                      current_deposit.permission_class)
+    assert action_admin_access in admin_permission_factory().needs
+    with app.test_request_context() as ctx:
+        login_user(users[0])
+        assert not can_admin()
+        assert {users[0].id: False} == ctx.request._deposit_admin_access
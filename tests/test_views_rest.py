@@ -35,7 +35,9 @@ from flask import url_for
 from flask_security import url_for_security
 from invenio_search import current_search
 from six import BytesIO
+from sqlalchemy import event
 
+from invenio_deposit import tasks
 from invenio_deposit.api import Deposit
 
 
@@ -85,6 +87,212 @@ def test_publish_merge_conflict(app, db, es, users, location, deposit,
             assert res.status_code == 409
 
 
+def test_deferred_indexing_request(app, db, es, users, location, deposit,
+                                   json_headers, monkeypatch):
+    """Test that a request sends its deposits once for bulk indexing."""
+    bulk = []
+    monkeypatch.setattr(Deposit.indexer, 'bulk_index',
+                        lambda ids: bulk.append(list(ids)))
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    app.config['DEPOSIT_DEFERRED_INDEXING'] = True
+    with app.test_request_context():
+        with app.test_client() as client:
+            user_info = dict(email=users[0].email, password='tester')
+            # login
+            res = client.post(url_for_security('login'), data=user_info)
+            res = client.put(
+                url_for('invenio_deposit_rest.depid_item',
+                        pid_value=deposit['_deposit']['id']),
+                data=json.dumps({"title": "bar"}),
+                headers=json_headers
+            )
+            assert res.status_code == 200
+    assert [[str(deposit.id)]] == bulk
+
+
+def test_action_indexing(app, db, es, users, location, deposit,
+                         fake_schemas, monkeypatch):
+    """Test that an action indexes the deposit and record once."""
+    bulk, indexed = [], []
+    monkeypatch.setattr(Deposit.indexer, 'bulk_index',
+                        lambda ids: bulk.append(list(ids)))
+    monkeypatch.setattr(Deposit.indexer, 'index',
+                        lambda record: indexed.append(str(record.id)))
+    monkeypatch.setattr(
+        'invenio_deposit.indexer.process_bulk_queue.delay', lambda: None)
+    monkeypatch.setattr('invenio_deposit.receivers.index_record.delay',
+                        lambda record_id: indexed.append(record_id))
+    with app.test_request_context():
+        with app.test_client() as client:
+            user_info = dict(email=users[0].email, password='tester')
+            # login
+            res = client.post(url_for_security('login'), data=user_info)
+            url = url_for('invenio_deposit_rest.depid_actions',
+                          pid_value=deposit['_deposit']['id'],
+                          action='publish')
+
+            # indexed directly after the commit
+            res = client.post(url)
+            assert res.status_code == 202
+            _, record = Deposit.get_record(deposit.id).fetch_published()
+            assert [str(deposit.id), str(record.id)] == indexed
+            assert [] == bulk
+
+            res = client.post(url_for(
+                'invenio_deposit_rest.depid_actions',
+                pid_value=deposit['_deposit']['id'], action='edit'))
+            assert res.status_code == 201
+            del indexed[:]
+
+            # sent in one bulk request
+            app.config['DEPOSIT_DEFERRED_INDEXING'] = True
+            res = client.post(url)
+            assert res.status_code == 202
+    assert [] == indexed
+    assert [[str(deposit.id), str(record.id)]] == bulk
+
+
+def test_action_if_match(app, db, es, users, location, deposit,
+                         json_headers, fake_schemas):
+    """Test conditional deposit actions."""
+    with app.test_request_context():
+        with app.test_client() as client:
+            user_info = dict(email=users[0].email, password='tester')
+            # login
+            res = client.post(url_for_security('login'), data=user_info)
+            url = url_for('invenio_deposit_rest.depid_actions',
+                          pid_value=deposit['_deposit']['id'],
+                          action='publish')
+
+            # stale revision
+            res = client.post(url, headers=[
+                ('If-Match', '"{0}"'.format(deposit.revision_id - 1))])
+            assert res.status_code == 412
+            assert 'draft' == Deposit.get_record(
+                deposit.id)['_deposit']['status']
+
+            res = client.post(url, headers=[
+                ('If-Match', '"{0}"'.format(deposit.revision_id))])
+            assert res.status_code == 202
+            revision_id = Deposit.get_record(deposit.id).revision_id
+            assert res.headers['ETag'] == '"{0}"'.format(revision_id)
+
+
+def test_action_response_queries(app, db, es, users, location, deposit,
+                                 json_headers, fake_schemas, monkeypatch):
+    """Test that actions do not reload the rows they have just written."""
+    monkeypatch.setattr('invenio_deposit.receivers.index_record.delay',
+                        lambda record_id: None)
+    statements = []
+
+    def on_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def on_commit(conn):
+        statements.append('COMMIT')
+
+    with app.test_request_context():
+        with app.test_client() as client:
+            user_info = dict(email=users[0].email, password='tester')
+            # login
+            res = client.post(url_for_security('login'), data=user_info)
+
+            for action, status in (('publish', 202), ('edit', 201),
+                                   ('discard', 201)):
+                del statements[:]
+                event.listen(db.engine, 'before_cursor_execute', on_execute)
+                event.listen(db.engine, 'commit', on_commit)
+                try:
+                    res = client.post(url_for(
+                        'invenio_deposit_rest.depid_actions',
+                        pid_value=deposit['_deposit']['id'], action=action))
+                finally:
+                    event.remove(db.engine, 'before_cursor_execute',
+                                 on_execute)
+                    event.remove(db.engine, 'commit', on_commit)
+                assert res.status_code == status
+
+                after_commit = statements[
+                    len(statements) - statements[::-1].index('COMMIT'):]
+                assert not [
+                    statement for statement in after_commit
+                    if 'records_metadata' in statement or
+                    'pidstore_pid' in statement
+                ]
+                data = json.loads(res.data.decode('utf-8'))
+                current = Deposit.get_record(deposit.id)
+                assert current['_deposit']['status'] == \
+                    data['metadata']['_deposit']['status']
+                assert res.headers['ETag'] == \
+                    '"{0}"'.format(current.revision_id)
+
+
+def test_publish_async(app, db, es, users, location, deposit,
+                       json_headers, fake_schemas, monkeypatch):
+    """Test publishing a deposit in a background task."""
+    app.config['DEPOSIT_ASYNC_PUBLISH'] = True
+    with app.test_request_context():
+        with app.test_client() as client:
+            user_info = dict(email=users[0].email, password='tester')
+            # login
+            res = client.post(url_for_security('login'), data=user_info)
+            url = url_for('invenio_deposit_rest.depid_actions',
+                          pid_value=deposit['_deposit']['id'],
+                          action='publish')
+
+            res = client.post(url)
+            assert res.status_code == 202
+            data = json.loads(res.data.decode('utf-8'))
+            assert 'publish' == data['action']
+            assert res.headers['Location'] == data['links']['self']
+
+            res = client.get(data['links']['self'])
+            assert res.status_code == 200
+            assert 'done' == json.loads(res.data.decode('utf-8'))['status']
+            deposit = Deposit.get_record(deposit.id)
+            assert 'published' == deposit['_deposit']['status']
+
+            # already published
+            res = client.post(url)
+            assert res.status_code == 403
+
+            # failing job
+            deposit = deposit.edit()
+            db.session.commit()
+
+            def fail(self, *args, **kwargs):
+                raise ValueError('Internal details.')
+
+            monkeypatch.setattr(Deposit, 'publish', fail)
+            res = client.post(url)
+            assert res.status_code == 202
+            res = client.get(res.headers['Location'])
+            data = json.loads(res.data.decode('utf-8'))
+            assert 'failed' == data['status']
+            assert 'Publishing failed.' == data['message']
+            assert 'Internal details.' not in res.data.decode('utf-8')
+            assert 'draft' == Deposit.get_record(
+                deposit.id)['_deposit']['status']
+
+            # unknown job
+            res = client.get(url_for(
+                'invenio_deposit_rest.depid_job',
+                pid_value=deposit['_deposit']['id'],
+                job_id='00000000-0000-0000-0000-000000000000'))
+            assert res.status_code == 404
+
+            # a missing job is ignored by the task
+            tasks.publish('00000000-0000-0000-0000-000000000000')
+
+        with app.test_client() as client:
+            # the user is NOT the owner
+            res = client.post(url_for_security('login'), data=dict(
+                email=users[1].email, password='tester2'))
+            res = client.get(data['links']['self'])
+            assert res.status_code == 403
+
+
 @pytest.mark.parametrize('user_info,status', [
     # anonymous user
     (None, 401),
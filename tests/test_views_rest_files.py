@@ -28,12 +28,17 @@ from __future__ import absolute_import, print_function
 
 import hashlib
 import json
+import os
+import tarfile
 
 from flask import url_for
 from flask_security import login_user, url_for_security
+from invenio_files_rest.models import Bucket, FileInstance, Location, \
+    ObjectVersion
 from six import BytesIO
 
 from invenio_deposit.api import Deposit
+from invenio_deposit.models import MultipartUpload
 
 
 def test_created_by_population(app, db, users):
@@ -589,3 +594,389 @@ def test_file_put(app, db, deposit, files, users):
             assert data['filename'] == obj.key
             assert data['checksum'] == obj.file.checksum
             assert data['id'] == str(obj.file.id)
+
+
+def test_file_put_stream(app, db, deposit, users):
+    """PUT the content of a deposit file as a raw stream."""
+    content = b'### Testing streamed textfile ###'
+    digest = 'md5:{0}'.format(hashlib.md5(content).hexdigest())
+    with app.test_request_context():
+        with app.test_client() as client:
+            # login
+            res = client.post(url_for_security('login'), data=dict(
+                email=users[0].email,
+                password="tester"
+            ))
+            url = url_for('invenio_deposit_rest.depid_file',
+                          pid_value=deposit['_deposit']['id'],
+                          key='stream.txt')
+            res = client.put(url, data=content,
+                             content_type='application/octet-stream')
+            assert res.status_code == 201
+            data = json.loads(res.data.decode('utf-8'))
+            assert data['filename'] == 'stream.txt'
+            assert data['checksum'] == digest
+            assert data['filesize'] == len(content)
+
+            # replace the content
+            res = client.put(url, data=b'new content',
+                             content_type='application/octet-stream')
+            assert res.status_code == 200
+            data = json.loads(res.data.decode('utf-8'))
+            assert data['filesize'] == len(b'new content')
+
+            # invalid file name
+            res = client.put(
+                url_for('invenio_deposit_rest.depid_file',
+                        pid_value=deposit['_deposit']['id'],
+                        key='stream file.txt'),
+                data=content,
+                content_type='application/octet-stream')
+            assert res.status_code == 400
+
+            # missing content length
+            res = client.put(url, data=content,
+                             environ_overrides={'CONTENT_LENGTH': ''},
+                             content_type='application/octet-stream')
+            assert res.status_code == 411
+            res = client.get(url)
+            assert json.loads(res.data.decode('utf-8'))['filesize'] == \
+                len(b'new content')
+
+
+def test_file_etag(app, db, deposit, users):
+    """Test conditional requests on deposit files."""
+    with app.test_request_context():
+        with app.test_client() as client:
+            # login
+            res = client.post(url_for_security('login'), data=dict(
+                email=users[0].email,
+                password="tester"
+            ))
+            url = url_for('invenio_deposit_rest.depid_file',
+                          pid_value=deposit['_deposit']['id'],
+                          key='etag.txt')
+            res = client.put(url, data=b'first',
+                             content_type='application/octet-stream')
+            assert res.status_code == 201
+            etag = res.headers['ETag']
+
+            res = client.get(url)
+            assert res.status_code == 200
+            assert etag == res.headers['ETag']
+            res = client.get(url, headers=[('If-None-Match', etag)])
+            assert res.status_code == 304
+            assert etag == res.headers['ETag']
+
+            res = client.put(url, data=b'second', headers=[
+                ('If-Match', etag)], content_type='application/octet-stream')
+            assert res.status_code == 200
+            assert etag != res.headers['ETag']
+
+            # stale ETag
+            res = client.put(url, data=b'third', headers=[
+                ('If-Match', etag)], content_type='application/octet-stream')
+            assert res.status_code == 412
+            res = client.delete(url, headers=[('If-Match', etag)])
+            assert res.status_code == 412
+            res = client.get(url, headers=[('If-None-Match', etag)])
+            assert res.status_code == 200
+
+
+def test_file_multipart_upload(app, db, deposit, users, fake_schemas):
+    """Upload a deposit file in several parts."""
+    parts = [b'first part, ', b'second part, ', b'third part']
+    digest = 'md5:{0}'.format(hashlib.md5(b''.join(parts)).hexdigest())
+    with app.test_request_context():
+        with app.test_client() as client:
+            # login
+            res = client.post(url_for_security('login'), data=dict(
+                email=users[0].email,
+                password="tester"
+            ))
+            url = url_for('invenio_deposit_rest.depid_file',
+                          pid_value=deposit['_deposit']['id'],
+                          key='multipart.txt')
+            # start the upload
+            res = client.post(url + '?uploads')
+            assert res.status_code == 201
+            data = json.loads(res.data.decode('utf-8'))
+            assert data['filename'] == 'multipart.txt'
+            assert data['parts'] == []
+            upload_id = data['upload_id']
+
+            # upload the parts in any order
+            for part_number in (3, 1, 2):
+                res = client.put(
+                    '{0}?upload_id={1}&part_number={2}'.format(
+                        url, upload_id, part_number),
+                    data=parts[part_number - 1],
+                    content_type='application/octet-stream')
+                assert res.status_code == 200
+
+            # invalid part number
+            res = client.put(
+                '{0}?upload_id={1}&part_number=0'.format(url, upload_id),
+                data=b'invalid', content_type='application/octet-stream')
+            assert res.status_code == 400
+
+            # complete the upload
+            bucket_id = MultipartUpload.query.get(upload_id).bucket_id
+            res = client.post('{0}?upload_id={1}'.format(url, upload_id))
+            assert res.status_code == 201
+            assert Bucket.query.get(bucket_id) is None
+            assert 0 == ObjectVersion.query.filter_by(
+                bucket_id=bucket_id).count()
+            data = json.loads(res.data.decode('utf-8'))
+            assert data['filename'] == 'multipart.txt'
+            assert data['checksum'] == digest
+
+            # the upload does not exist anymore
+            res = client.post('{0}?upload_id={1}'.format(url, upload_id))
+            assert res.status_code == 404
+
+            # abort an upload
+            res = client.post(url + '?uploads')
+            upload_id = json.loads(res.data.decode('utf-8'))['upload_id']
+            res = client.put(
+                '{0}?upload_id={1}&part_number=1'.format(url, upload_id),
+                data=parts[0], content_type='application/octet-stream')
+            upload = MultipartUpload.query.get(upload_id)
+            bucket_id = upload.bucket_id
+            file_ids = [obj.file_id for obj in upload.parts]
+            res = client.delete('{0}?upload_id={1}'.format(url, upload_id))
+            assert res.status_code == 204
+            assert Bucket.query.get(bucket_id) is None
+            assert 0 == ObjectVersion.query.filter_by(
+                bucket_id=bucket_id).count()
+            assert 0 == FileInstance.query.filter(
+                FileInstance.id.in_(file_ids)).count()
+            res = client.put(
+                '{0}?upload_id={1}&part_number=1'.format(url, upload_id),
+                data=parts[0], content_type='application/octet-stream')
+            assert res.status_code == 404
+
+            # start an upload with newline delimited JSON
+            res = client.post(url + '?uploads', headers=[
+                ('Accept', 'application/x-ndjson')])
+            assert res.status_code == 201
+            assert res.mimetype == 'application/x-ndjson'
+            data = json.loads(res.data.decode('utf-8'))
+            assert data['filename'] == 'multipart.txt'
+            assert data['parts'] == []
+            upload_id = data['upload_id']
+
+            # neither starting nor completing an upload
+            res = client.post(url)
+            assert res.status_code == 400
+
+            # no parts are accepted once the deposit is published
+            Deposit.get_record(deposit.id).publish()
+            db.session.commit()
+            res = client.put(
+                '{0}?upload_id={1}&part_number=1'.format(url, upload_id),
+                data=parts[0], content_type='application/octet-stream')
+            assert res.status_code == 403
+
+
+def make_archive(*files):
+    """Create a gzipped tar archive of ``(name, content)`` pairs."""
+    archive = BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, BytesIO(content))
+    return archive.getvalue()
+
+
+def stored_files():
+    """List the data files in the default storage location."""
+    return sorted(
+        os.path.join(root, name)
+        for root, dirs, names in os.walk(Location.get_default().uri)
+        for name in names
+    )
+
+
+def test_files_post_batch(app, db, deposit, users):
+    """Post several deposit files in one request."""
+    archive = make_archive(('a.txt', b'A'), ('dir/b.txt', b'BB'))
+    with app.test_request_context():
+        with app.test_client() as client:
+            # login
+            res = client.post(url_for_security('login'), data=dict(
+                email=users[0].email,
+                password="tester"
+            ))
+            url = url_for('invenio_deposit_rest.depid_files',
+                          pid_value=deposit['_deposit']['id'])
+            # upload several parts
+            res = client.post(
+                url,
+                data={'files': [(BytesIO(b'1'), 'one.txt'),
+                                (BytesIO(b'22'), 'two.txt')]},
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 201
+            data = json.loads(res.data.decode('utf-8'))
+            assert ['one.txt', 'two.txt'] == [f['filename'] for f in data]
+
+            # upload an archive
+            res = client.post(url, data=archive,
+                              content_type='application/x-tar')
+            assert res.status_code == 201
+            data = json.loads(res.data.decode('utf-8'))
+            assert ['one.txt', 'two.txt', 'a.txt', 'dir_b.txt'] == \
+                [f['filename'] for f in data]
+            assert [1, 2, 1, 2] == [f['filesize'] for f in data]
+
+            # existing file
+            res = client.post(
+                url,
+                data={'files': [(BytesIO(b'1'), 'one.txt')]},
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 400
+
+            # invalid archive
+            res = client.post(url, data=b'not an archive',
+                              content_type='application/zip')
+            assert res.status_code == 400
+
+            # truncated archive
+            stored = stored_files()
+            res = client.post(url, data=archive[:len(archive) // 2],
+                              content_type='application/x-tar')
+            assert res.status_code == 400
+            assert stored == stored_files()
+
+            # the data of files added before a failing member is removed
+            res = client.post(
+                url, data=make_archive(('c.txt', b'C'), ('one.txt', b'1')),
+                content_type='application/x-tar')
+            assert res.status_code == 400
+            assert stored == stored_files()
+            res = client.get(url)
+            assert 'c.txt' not in [
+                f['filename'] for f in json.loads(res.data.decode('utf-8'))]
+
+
+def test_files_get_paginated(app, db, deposit, users):
+    """Get deposit files page by page and as a stream."""
+    keys = ['file-{0}.txt'.format(i) for i in range(5)]
+    for key in reversed(keys):
+        deposit.files[key] = BytesIO(key.encode('utf-8'))
+    deposit.commit()
+    db.session.commit()
+    with app.test_request_context():
+        with app.test_client() as client:
+            # login
+            res = client.post(url_for_security('login'), data=dict(
+                email=users[0].email,
+                password="tester"
+            ))
+            url = url_for('invenio_deposit_rest.depid_files',
+                          pid_value=deposit['_deposit']['id'], size=2)
+            pages = []
+            while url:
+                res = client.get(url)
+                assert res.status_code == 200
+                pages.append([f['filename'] for f in json.loads(
+                    res.data.decode('utf-8'))])
+                link = res.headers.get('Link')
+                url = link[1:link.index('>')] if link else None
+            assert [keys[0:2], keys[2:4], keys[4:]] == pages
+
+            # stream all files in the deposit order
+            res = client.get(
+                url_for('invenio_deposit_rest.depid_files',
+                        pid_value=deposit['_deposit']['id']),
+                headers=[('Accept', 'application/x-ndjson')]
+            )
+            assert res.status_code == 200
+            assert res.mimetype == 'application/x-ndjson'
+            lines = res.data.decode('utf-8').splitlines()
+            assert list(reversed(keys)) == \
+                [json.loads(line)['filename'] for line in lines]
+
+            # the page size is limited
+            app.config['DEPOSIT_FILES_MAX_PAGE_SIZE'] = 3
+            res = client.get(url_for(
+                'invenio_deposit_rest.depid_files',
+                pid_value=deposit['_deposit']['id'], size=100000000))
+            assert res.status_code == 200
+            assert keys[:3] == [
+                f['filename'] for f in json.loads(res.data.decode('utf-8'))]
+            assert 'size=3' in res.headers['Link']
+
+            # a page given only by its start has the maximum size
+            res = client.get(url_for(
+                'invenio_deposit_rest.depid_files',
+                pid_value=deposit['_deposit']['id'], after=keys[0]))
+            assert res.status_code == 200
+            assert keys[1:4] == [
+                f['filename'] for f in json.loads(res.data.decode('utf-8'))]
+            assert 'size=3' in res.headers['Link']
+
+
+def test_files_get_etag(app, db, deposit, users):
+    """Test conditional requests on the deposit files listing."""
+    deposit.files['first.txt'] = BytesIO(b'first')
+    deposit.commit()
+    db.session.commit()
+    with app.test_request_context():
+        with app.test_client() as client:
+            # login
+            res = client.post(url_for_security('login'), data=dict(
+                email=users[0].email,
+                password="tester"
+            ))
+            url = url_for('invenio_deposit_rest.depid_files',
+                          pid_value=deposit['_deposit']['id'])
+            res = client.get(url)
+            assert res.status_code == 200
+            etag = res.headers['ETag']
+
+            assert 'Accept' in res.headers['Vary']
+
+            res = client.get(url, headers=[('If-None-Match', etag)])
+            assert res.status_code == 304
+            assert etag == res.headers['ETag']
+            assert 'Accept' in res.headers['Vary']
+            assert b'' == res.data
+
+            res = client.get(url, headers=[('Accept', 'application/json')])
+            assert etag == res.headers['ETag']
+
+            # each representation has its own ETag
+            ndjson = [('Accept', 'application/x-ndjson')]
+            res = client.get(url, headers=ndjson + [('If-None-Match', etag)])
+            assert res.status_code == 200
+            ndjson_etag = res.headers['ETag']
+            assert etag != ndjson_etag
+
+            # the listing changes with a new file, If-Match accepts the ETag
+            # of any representation of the stored files
+            res = client.post(
+                url,
+                data={'files': [(BytesIO(b'2'), 'second.txt')]},
+                headers=[('If-Match', ndjson_etag), ('Accept', '*/*')],
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 201
+            new_etag = res.headers['ETag']
+            assert etag != new_etag
+
+            res = client.get(url, headers=[('If-None-Match', etag)])
+            assert res.status_code == 200
+            assert new_etag == res.headers['ETag']
+
+            # stale ETag
+            res = client.post(
+                url,
+                data={'files': [(BytesIO(b'3'), 'third.txt')]},
+                headers=[('If-Match', etag)],
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 412